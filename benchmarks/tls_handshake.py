@@ -0,0 +1,87 @@
+"""
+Compares full vs resumed TLS handshake cost against a context built by MudLinkManager.register_ssl.
+
+    python benchmarks/tls_handshake.py --cert server.pem --key server.key --clients 500
+
+A throwaway certificate can be made with:
+
+    openssl req -x509 -newkey rsa:2048 -nodes -subj /CN=localhost -keyout server.key -out server.pem
+"""
+import argparse
+import asyncio
+import socket
+import ssl
+import threading
+import time
+
+from mudlink.mudlink import MudLinkManager
+
+
+def serve(context, ready, holder):
+    async def greet(reader, writer):
+        # Something must be read by the client before TLS 1.3 session tickets arrive.
+        writer.write(b"\xff\xfb\x56")
+        await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(greet, host="127.0.0.1", port=0, ssl=context)
+        holder.append(server.sockets[0].getsockname()[1])
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def connect(client, port, session=None):
+    with socket.create_connection(("127.0.0.1", port)) as raw:
+        with client.wrap_socket(raw, server_hostname="localhost", session=session) as tls:
+            tls.recv(3)
+            return tls.session, tls.session_reused
+
+
+def run(client, port, clients, resume):
+    session = None
+    reused = 0
+    start = time.perf_counter()
+    for _ in range(clients):
+        new_session, was_reused = connect(client, port, session if resume else None)
+        reused += was_reused
+        if resume and new_session is not None:
+            session = new_session
+    return time.perf_counter() - start, reused
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cert", required=True)
+    parser.add_argument("--key", default=None)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--tls12", action="store_true", help="Cap the client at TLS 1.2")
+    args = parser.parse_args()
+
+    manager = MudLinkManager()
+    context = manager.register_ssl("bench", args.cert, key_path=args.key)
+
+    ready = threading.Event()
+    holder = list()
+    threading.Thread(target=serve, args=(context, ready, holder), daemon=True).start()
+    ready.wait()
+    port = holder[0]
+
+    client = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client.check_hostname = False
+    client.verify_mode = ssl.CERT_NONE
+    if args.tls12:
+        client.maximum_version = ssl.TLSVersion.TLSv1_2
+
+    full, _ = run(client, port, args.clients, False)
+    resumed, reused = run(client, port, args.clients, True)
+    print(f"full handshakes:    {args.clients} in {full:.3f}s ({full / args.clients * 1000:.3f} ms each)")
+    print(f"resumed handshakes: {args.clients} in {resumed:.3f}s ({resumed / args.clients * 1000:.3f} ms each), "
+          f"{reused} reused")
+
+
+if __name__ == "__main__":
+    main()
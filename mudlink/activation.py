@@ -0,0 +1,40 @@
+import os
+import socket
+
+# Inherited descriptors start right after stdin/stdout/stderr.
+LISTEN_FDS_START = 3
+
+
+def listen_fds(unset_environment=True):
+    """
+    Collects listening sockets passed in by a service manager using the systemd socket activation
+    convention (LISTEN_PID, LISTEN_FDS and optionally LISTEN_FDNAMES). Returns {name: [socket, ...]}, where
+    descriptors without a name are filed under "unknown" as systemd does. Returns an empty dict if nothing
+    was passed to this process.
+
+    Because the manager owns the sockets, connections made while this process restarts wait in the kernel
+    backlog instead of being refused.
+    """
+    try:
+        pid = int(os.environ.get("LISTEN_PID", ""))
+        count = int(os.environ.get("LISTEN_FDS", ""))
+    except ValueError:
+        return dict()
+    names = os.environ.get("LISTEN_FDNAMES", "").split(":")
+    if unset_environment:
+        # Child processes must not think these were meant for them.
+        for var in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+            os.environ.pop(var, None)
+    if pid != os.getpid():
+        return dict()
+
+    out = dict()
+    for i in range(count):
+        fd = LISTEN_FDS_START + i
+        os.set_inheritable(fd, False)
+        # Family and type are detected from the descriptor itself.
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        name = names[i] if i < len(names) and names[i] else "unknown"
+        out.setdefault(name, list()).append(sock)
+    return out
@@ -0,0 +1,111 @@
+import ipaddress
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+
+    def take(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+class BucketTable:
+    """
+    An LRU-bounded table of TokenBuckets. When the table is full the least recently seen key is dropped,
+    which simply grants that key a fresh bucket should it come back.
+    """
+
+    def __init__(self, rate, burst, size):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.buckets = OrderedDict()
+
+    def take(self, key, now):
+        bucket = self.buckets.get(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(self.rate, self.burst, now)
+
+
+class AdmissionController:
+    """
+    Decides whether a freshly accepted socket is allowed to become a MudConnection at all.
+
+    Checked, in order: the listener's concurrent connection cap, a per-IP token bucket, and a per-subnet
+    token bucket. A rate of 0 disables that check.
+    """
+
+    def __init__(self, max_connections=0, ip_rate=1.0, ip_burst=5, subnet_rate=10.0, subnet_burst=30,
+                 ipv4_prefix=24, ipv6_prefix=64, table_size=4096,
+                 reject_message=b"Too many connections. Please try again later.\r\n"):
+        self.max_connections = max_connections
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.reject_message = reject_message
+        self.ip_table = BucketTable(ip_rate, ip_burst, table_size) if ip_rate else None
+        self.subnet_table = BucketTable(subnet_rate, subnet_burst, table_size) if subnet_rate else None
+        self.active = 0
+        self.accepted = 0
+        self.rejected = {"capacity": 0, "ip_rate": 0, "subnet_rate": 0}
+
+    def subnet(self, host):
+        try:
+            addr = ipaddress.ip_address(host)
+        except ValueError:
+            return host
+        if addr.version == 4:
+            return ipaddress.ip_network((addr, self.ipv4_prefix), strict=False)
+        if addr.ipv4_mapped:
+            return ipaddress.ip_network((addr.ipv4_mapped, self.ipv4_prefix), strict=False)
+        return ipaddress.ip_network((addr, self.ipv6_prefix), strict=False)
+
+    def check(self, host):
+        """
+        Returns None if the connection may proceed, or the name of the rule that rejected it.
+        """
+        if self.max_connections and self.active >= self.max_connections:
+            return "capacity"
+        now = time.monotonic()
+        if self.ip_table and not self.ip_table.take(host, now):
+            return "ip_rate"
+        if self.subnet_table and not self.subnet_table.take(self.subnet(host), now):
+            return "subnet_rate"
+        return None
+
+    def admit(self, host):
+        reason = self.check(host)
+        if reason:
+            self.rejected[reason] += 1
+            return False
+        self.active += 1
+        self.accepted += 1
+        return True
+
+    def release(self):
+        if self.active > 0:
+            self.active -= 1
+
+    def export(self):
+        return {
+            "active": self.active,
+            "accepted": self.accepted,
+            "rejected": dict(self.rejected),
+            "tracked_ips": len(self.ip_table.buckets) if self.ip_table else 0,
+            "tracked_subnets": len(self.subnet_table.buckets) if self.subnet_table else 0
+        }
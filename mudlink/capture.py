@@ -0,0 +1,80 @@
+import mmap
+import struct
+import time
+
+# File layout: MAGIC, then records of RECORD header followed by `length` bytes of payload.
+MAGIC = b"MUDCAP1\n"
+RECORD = struct.Struct("<dIBI")  # timestamp, connection id, kind, payload length
+
+KIND_OPEN = 0
+KIND_IN = 1
+KIND_OUT = 2
+KIND_CLOSE = 3
+
+
+class CaptureLog:
+    """
+    Append-only binary log of raw telnet traffic. Inbound bytes are recorded as read from the socket, and
+    outbound bytes as written by the connection before MCCP2 compression, so a replay can exercise the
+    compressor too.
+    """
+
+    def __init__(self, path, buffering=1 << 16):
+        self.path = path
+        self.file = open(path, "ab", buffering=buffering)
+        self.next_id = 1
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        else:
+            # Appending to an earlier run's log: carry on from its ids so replay doesn't merge connections.
+            for stamp, cid, kind, payload in read_capture(path):
+                if cid >= self.next_id:
+                    self.next_id = cid + 1
+
+    def open(self, conn):
+        cid = self.next_id
+        self.next_id += 1
+        self.record(cid, KIND_OPEN, f"{conn.name} {conn.host} {conn.host_port}".encode())
+        return cid
+
+    def record(self, cid, kind, data=b""):
+        if self.file.closed:
+            return
+        self.file.write(RECORD.pack(time.time(), cid, kind, len(data)))
+        if data:
+            self.file.write(data)
+
+    def flush(self):
+        if not self.file.closed:
+            self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_capture(path):
+    """
+    Yields (timestamp, connection id, kind, payload) from a capture log. The file is memory-mapped and
+    payloads are memoryviews into it, released as soon as the next record is requested.
+    """
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"Not a mudlink capture log: {path}")
+            view = memoryview(mm)
+            offset = len(MAGIC)
+            end = len(mm) - RECORD.size
+            try:
+                while offset <= end:
+                    stamp, cid, kind, length = RECORD.unpack_from(mm, offset)
+                    offset += RECORD.size
+                    payload = view[offset:offset + length]
+                    try:
+                        yield stamp, cid, kind, payload
+                    finally:
+                        # Also when the consumer stops early, or the mmap can't close.
+                        payload.release()
+                    offset += length
+            finally:
+                view.release()
@@ -0,0 +1,73 @@
+import time
+import inspect
+
+# IAC SB MSSP ... IAC SE
+MSSP_START = bytes([255, 250, 70])
+MSSP_END = bytes([255, 240])
+MSSP_VAR = 1
+MSSP_VAL = 2
+
+
+def _values(value):
+    if isinstance(value, (list, tuple, set)):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def encode_mssp(variables):
+    out = bytearray(MSSP_START)
+    for k, v in variables.items():
+        out.append(MSSP_VAR)
+        out += str(k).encode()
+        for val in _values(v):
+            out.append(MSSP_VAL)
+            out += val.encode()
+    out += MSSP_END
+    return bytes(out)
+
+
+def encode_mssp_text(variables):
+    lines = ["", "MSSP-REPLY-START"]
+    for k, v in variables.items():
+        lines.append("\t".join([str(k)] + _values(v)))
+    lines.append("MSSP-REPLY-END")
+    lines.append("")
+    return "\r\n".join(lines).encode()
+
+
+class MSSPProvider:
+    """
+    Holds the game's MSSP variables and caches their encoded forms, so crawlers can be answered without
+    rebuilding anything or involving the game.
+
+    variables may be a dict or a callable (sync, not async) returning one. The cache is rebuilt when it is
+    older than ttl seconds or after invalidate() is called.
+    """
+
+    def __init__(self, variables, ttl=60.0):
+        if inspect.iscoroutinefunction(variables):
+            raise ValueError("MSSP variables callable must not be a coroutine function")
+        self.variables = variables
+        self.ttl = ttl
+        self.expires = 0.0
+        self.telnet = b""
+        self.text = b""
+
+    def invalidate(self):
+        self.expires = 0.0
+
+    def refresh(self):
+        variables = self.variables() if callable(self.variables) else self.variables
+        self.telnet = encode_mssp(variables)
+        self.text = encode_mssp_text(variables)
+        self.expires = time.monotonic() + self.ttl
+
+    def get_telnet(self):
+        if time.monotonic() >= self.expires:
+            self.refresh()
+        return self.telnet
+
+    def get_text(self):
+        if time.monotonic() >= self.expires:
+            self.refresh()
+        return self.text
@@ -3,6 +3,21 @@ import random
 import string
 import datetime
 import inspect
+import time
+import functools
+import logging
+
+# Output priority lanes, highest first. Negotiation and control frames, then out-of-band data (GMCP, MSSP...),
+# then interactive text and prompts, then bulk text, which is split into BULK_CHUNK sized pieces so the
+# other lanes can cut in between them.
+LANE_CONTROL = 0
+LANE_OOB = 1
+LANE_TEXT = 2
+LANE_BULK = 3
+LANE_COUNT = 4
+BULK_CHUNK = 4096
+
+logger = logging.getLogger(__name__)
 
 
 class Capabilities:
@@ -21,6 +36,7 @@ class Capabilities:
         self.linemode = False
         self.force_endline = False
         self.suppress_ga = True
+        self.eor = False
         self.mouse_tracking = False
         self.utf8 = False
         self.vt100 = False
@@ -66,6 +82,8 @@ class AbstractConnection:
 
 
 class MudConnection(AbstractConnection):
+    # How many bulk chunks send_stream lets pile up before it stops pulling from its source.
+    stream_window = 2
 
     def __init__(self, listener):
         super().__init__()
@@ -77,10 +95,26 @@ class MudConnection(AbstractConnection):
         self.capabilities = Capabilities()
         self.tls = bool(listener.ssl_context)
         self.protocol = listener.protocol
+        # Commands and OOB wait here for the dispatch stage, so a slow game callback never stalls reading.
+        self.inbound = asyncio.Queue(maxsize=listener.manager.inbound_limit)
+        self.ready_event = asyncio.Event()
+        self.dispatch_latency = 0.0
+        self.dispatch_latency_max = 0.0
+        self.dispatch_task = None
+        self.update_task = None
+        self.last_capabilities = dict()
+        self.closing = False
+        self.stream_lock = asyncio.Lock()
+        self.bulk_drained = asyncio.Event()
+        self.released = False
 
     async def run(self):
         pass
 
+    def start_dispatch(self):
+        self.dispatch_task = asyncio.create_task(self.dispatch())
+        return self.dispatch_task
+
     def start(self):
         if not self.running:
             self.running = True
@@ -104,30 +138,184 @@ class MudConnection(AbstractConnection):
         if self.ready:
             return
         self.ready = True
+        # The game gets the full picture with on_ready; updates are diffed against it from here on.
+        self.last_capabilities = dict(self.capabilities.__dict__)
+        self.listener.manager.connections.reindex(self)
         print(f"{self} ready to ready {self.on_ready_cb}")
+        # The dispatch stage announces the connection and runs on_ready_cb ahead of any queued input, so a
+        # slow handler there never holds up reading or negotiation.
+        self.ready_event.set()
+
+    @property
+    def inbound_depth(self):
+        return self.inbound.qsize()
+
+    def export(self):
+        out = super().export()
+        out["inbound_depth"] = self.inbound.qsize()
+        out["dispatch_latency"] = self.dispatch_latency
+        out["dispatch_latency_max"] = self.dispatch_latency_max
+        return out
+
+    async def run_callback(self, cb, *args):
+        if inspect.iscoroutinefunction(cb):
+            await cb(*args)
+        elif self.listener.manager.run_sync_in_executor:
+            # The callback runs on another thread, so it must not touch the connection's output directly.
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.listener.manager.executor, functools.partial(cb, *args))
+        else:
+            cb(*args)
+
+    async def enqueue(self, kind, data):
+        """
+        Hands received input to the dispatch stage. Blocks only once the bounded inbound queue is full.
+        """
+        await self.inbound.put((kind, data, time.perf_counter()))
+
+    async def dispatch(self):
+        """
+        Runs game callbacks one at a time: the ready notification once the connection is ready, then queued
+        input in arrival order.
+        """
+        await self.ready_event.wait()
+        await self.run_item("ready", None)
+        while True:
+            kind, data, stamp = await self.inbound.get()
+            latency = time.perf_counter() - stamp
+            self.dispatch_latency = latency
+            if latency > self.dispatch_latency_max:
+                self.dispatch_latency_max = latency
+            if await self.run_item(kind, data):
+                return
+
+    async def run_item(self, kind, data):
+        """
+        Dispatches one item, timing it when profiling. Returns True once the connection is finished.
+        """
+        prof = self.listener.manager.profiler
+        if prof:
+            start = time.perf_counter_ns()
+        try:
+            done = await self.dispatch_item(kind, data)
+        except Exception:
+            # One broken callback must not stop every later command from being delivered.
+            logger.exception("Error in %s callback for connection %s", kind, self.name)
+            done = kind == "disconnect"
+        if prof:
+            prof.add(self, "callback", time.perf_counter_ns() - start)
+        return done
+
+    async def dispatch_item(self, kind, data):
+        """
+        Runs the callback for one inbound item. Returns True once the connection is finished.
+        """
+        if kind == "command":
+            await self.forward_command(data)
+        elif kind == "ready":
+            await self.forward_ready()
+        elif kind == "oob":
+            await self.forward_oob(data)
+        elif kind == "update":
+            await self.forward_update(data)
+        elif kind == "disconnect":
+            await self.forward_disconnect()
+            return True
+        return False
+
+    async def forward_ready(self):
+        await self.listener.manager.announce_conn(self)
         if callable(self.on_ready_cb):
-            if inspect.iscoroutinefunction(self.on_ready_cb):
-                await self.on_ready_cb(self)
-            else:
-                self.on_ready_cb(self)
+            await self.run_callback(self.on_ready_cb, self)
+
+    async def forward_command(self, data):
+        if data and callable(self.on_command_cb):
+            await self.run_callback(self.on_command_cb, self, data)
+
+    async def forward_oob(self, data):
+        if data and callable(self.on_oob_cb):
+            await self.run_callback(self.on_oob_cb, self, data)
+
+    async def forward_update(self, changed):
+        if callable(self.on_update_cb):
+            await self.run_callback(self.on_update_cb, self, changed)
+
+    async def forward_disconnect(self):
+        if callable(self.on_disconnect_cb):
+            await self.run_callback(self.on_disconnect_cb, self)
 
     async def close(self):
         pass
 
+    def release(self):
+        """
+        Gives back what the listener handed this connection when it was accepted, and takes it out of the
+        manager's registry. Called on every teardown path, clean or not; only the first call does anything.
+        """
+        if self.released:
+            return
+        self.released = True
+        self.listener.manager.connections.remove(self)
+        self.listener.release(self)
+
     async def on_disconnect(self):
-        self.listener.manager.connections.pop(self.name, None)
+        self.release()
+        # Let any send_stream waiting for room notice the connection is gone.
+        self.bulk_drained.set()
+        # Queued behind any commands still waiting, so the game sees them first. A connection that never
+        # became ready was never announced, so there is no one to tell.
+        if self.ready:
+            await self.enqueue("disconnect", None)
+        elif self.dispatch_task:
+            self.dispatch_task.cancel()
 
-        if callable(self.on_disconnect_cb):
-            if inspect.iscoroutinefunction(self.on_disconnect_cb):
-                await self.on_disconnect_cb(self)
-            else:
-                self.on_disconnect_cb(self)
+    def bulk_pending(self):
+        """
+        Returns how many bulk chunks are waiting to be written.
+        """
+        return 0
+
+    async def send_bulk(self, data):
+        pass
+
+    def check_bulk_drained(self):
+        if self.bulk_pending() < self.stream_window:
+            self.bulk_drained.set()
+
+    async def send_stream(self, source):
+        """
+        Sends the chunks of an async iterable on the bulk lane, pulling the next one only once the bulk lane has
+        drained below stream_window chunks. Since the writer waits on the transport, a large generated output
+        costs a few chunks of memory no matter its total size. Streams on one connection run one at a time.
+        """
+        async with self.stream_lock:
+            async for chunk in source:
+                while self.running and not self.closing and self.bulk_pending() >= self.stream_window:
+                    self.bulk_drained.clear()
+                    await self.bulk_drained.wait()
+                if not self.running or self.closing:
+                    break
+                await self.send_bulk(chunk)
 
     async def on_update(self):
-        if not self.ready:
+        """
+        Called whenever a capability may have changed. Notifications are coalesced: the first call opens a
+        window of manager.update_delay seconds, after which on_update_cb(conn, changed) is queued once with a
+        dict of only the Capabilities fields that differ from the last notification.
+        """
+        if not self.ready or self.update_task:
             return
-        if callable(self.on_update_cb):
-            if inspect.iscoroutinefunction(self.on_update_cb):
-                await self.on_update_cb(self)
-            else:
-                self.on_update_cb(self)
+        self.update_task = asyncio.create_task(self.debounce_update())
+
+    async def debounce_update(self):
+        await asyncio.sleep(self.listener.manager.update_delay)
+        self.update_task = None
+        current = dict(self.capabilities.__dict__)
+        previous = self.last_capabilities
+        changed = {k: v for k, v in current.items() if previous.get(k, None) != v}
+        if not changed:
+            return
+        self.last_capabilities = current
+        self.listener.manager.connections.reindex(self)
+        if self.running and callable(self.on_update_cb):
+            await self.enqueue("update", changed)
@@ -1,14 +1,41 @@
 import asyncio
+import errno
+import ipaddress
+import logging
+import os
+import socket
 import ssl
+import stat
 import inspect
 import websockets
 from . telnet import TelnetMudConnection
 from . websocket import WebSocketConnection
+from . mssp import MSSPProvider
+from . capture import CaptureLog
+from . profiling import Profiler
+from . splice import StaticCache
+from . profiles import ClientProfileCache
+from . proxyproto import recv_proxy_header, ProxyProtocolError
+from . activation import listen_fds
+from . registry import ConnectionRegistry
+
+logger = logging.getLogger(__name__)
+
+# accept() errors that mean the process is out of resources. Retrying straight away would spin.
+ACCEPT_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+# Peers allowed to send a PROXY header unless a listener says otherwise: a proxy on the same host.
+PROXY_TRUSTED = ("127.0.0.0/8", "::1/128")
+
+# Unix domain socket peers have no address; they're admitted and shown under this one.
+UNIX_PEER = ("unix", 0)
 
 
 class MudListener:
 
-    def __init__(self, manager, name, interface, port, protocol, ssl_context=None):
+    def __init__(self, manager, name, interface, port, protocol, ssl_context=None, admission=None, capture=None,
+                 proxy_protocol=False, proxy_timeout=5.0, proxy_trusted=PROXY_TRUSTED, path=None, sock=None,
+                 backlog=100, max_pending=64):
         self.manager = manager
         self.name = name
         self.interface = interface
@@ -18,13 +45,127 @@ class MudListener:
         self.task = None
         self.running = False
         self.server = None
+        self.admission = admission
+        if isinstance(capture, str):
+            capture = CaptureLog(capture)
+        self.capture = capture
+        self.proxy_protocol = proxy_protocol
+        self.proxy_timeout = proxy_timeout
+        # Networks whose connections may carry a PROXY header. Anyone else could claim any address they liked,
+        # so they're turned away before the header is read. Unix domain socket peers are always trusted.
+        self.proxy_trusted = tuple(ipaddress.ip_network(n) for n in proxy_trusted)
+        self.proxy_rejected = 0
+        # A Unix domain socket path to bind instead of interface/port.
+        self.path = path
+        # An already-listening socket, e.g. one inherited through socket activation. It belongs to whoever
+        # passed it in, so it's never replaced by one bound here.
+        self.socket = sock
+        self.inherited = sock is not None
+        self.backlog = backlog
+        # For the raw accept loop: connections still reading a PROXY header or doing a TLS handshake. Past
+        # max_pending, accepting pauses and new connections wait in the kernel backlog.
+        self.max_pending = max_pending
+        self.pending = set()
+
+    def bind(self):
+        """
+        Creates the listening socket, if there isn't one already. Called by MudLinkManager.listen() before any
+        listener starts, so a port in use or a bad path is raised to the caller instead of dying in a task.
+        Returns True if a socket was created by this call.
+        """
+        if self.inherited:
+            if self.socket.fileno() == -1:
+                raise OSError(errno.EBADF, f"Inherited socket for listener {self.name} has been closed")
+            return False
+        if self.socket:
+            return False
+        if self.path:
+            try:
+                if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                    # Left behind by a previous run; a live one would still have refused the bind anyway.
+                    os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.bind(self.path)
+                sock.listen(self.backlog)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            family, _, _, _, address = socket.getaddrinfo(self.interface, self.port, type=socket.SOCK_STREAM,
+                                                          flags=socket.AI_PASSIVE)[0]
+            sock = socket.create_server(address, family=family, backlog=self.backlog)
+            # Port 0 asks the OS to choose.
+            self.port = sock.getsockname()[1]
+        sock.setblocking(False)
+        self.socket = sock
+        return True
+
+    def unbind(self):
+        """
+        Closes a listening socket created by bind(), removing its Unix socket path. Inherited sockets are left
+        alone.
+        """
+        if self.inherited or not self.socket:
+            return
+        self.socket.close()
+        self.socket = None
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
 
     async def run(self):
-        if self.protocol == "telnet":
-            self.server = await asyncio.start_server(self.accept_telnet, host=self.interface, port=self.port,
-                                                     ssl=self.ssl_context)
-        elif self.protocol == "websocket":
-            self.server = await websockets.serve(self.accept_websocket, self.interface, self.port, ssl=self.ssl_context)
+        self.bind()
+        if self.protocol == "telnet" and (self.proxy_protocol or (self.ssl_context and self.admission)):
+            await self.serve_raw()
+            return
+        sock = self.socket
+        if self.inherited:
+            # Closing a server closes the socket it was given. A copy keeps the inherited one listening, so
+            # the listener can be started again.
+            sock = sock.dup()
+            sock.setblocking(False)
+        try:
+            if self.protocol == "telnet":
+                self.server = await asyncio.start_server(self.accept_telnet, sock=sock, ssl=self.ssl_context)
+            elif self.protocol == "websocket":
+                self.server = await websockets.serve(self.accept_websocket, sock=sock, ssl=self.ssl_context)
+        except BaseException:
+            if sock is not self.socket:
+                sock.close()
+            raise
+
+    async def serve_raw(self):
+        """
+        Accept loop for telnet listeners that need to look at a connection before asyncio's transport (and TLS)
+        takes it over: to read a PROXY header without consuming any byte after it, and to turn away rejected
+        connections before a TLS handshake is spent on them.
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_pending)
+        delay = 0.0
+        while True:
+            await slots.acquire()
+            try:
+                client, address = await loop.sock_accept(self.socket)
+            except OSError as e:
+                slots.release()
+                if e.errno not in ACCEPT_RESOURCE_ERRORS:
+                    # e.g. ECONNABORTED: that one connection is gone, the listener is fine.
+                    continue
+                delay = min(max(delay * 2, 0.05), 1.0)
+                logger.warning("Listener %s can't accept connections (%s), retrying in %.2fs", self.name, e, delay)
+                await asyncio.sleep(delay)
+                continue
+            delay = 0.0
+            task = asyncio.create_task(self.accept_raw(client, address))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+            task.add_done_callback(lambda t: slots.release())
 
     def start(self):
         if not self.running:
@@ -36,55 +177,272 @@ class MudListener:
             self.task.cancel()
             self.task = None
         self.running = False
+        for task in list(self.pending):
+            task.cancel()
+        if self.server:
+            self.server.close()
+            self.server = None
+        self.unbind()
+        if self.capture:
+            self.capture.flush()
 
     def accept_telnet(self, reader, writer):
-        conn = TelnetMudConnection(self, reader, writer)
+        self.admit_telnet(reader, writer, writer.get_extra_info('peername'))
+
+    async def accept_raw(self, client, address):
+        loop = asyncio.get_running_loop()
+        client.setblocking(False)
+        admitted = False
+        try:
+            if self.proxy_protocol:
+                if not self.proxy_peer_trusted(address):
+                    self.proxy_rejected += 1
+                    client.close()
+                    return
+                try:
+                    address = await asyncio.wait_for(recv_proxy_header(loop, client), self.proxy_timeout) or address
+                except (ProxyProtocolError, asyncio.TimeoutError, OSError):
+                    self.proxy_rejected += 1
+                    client.close()
+                    return
+            peername = address or UNIX_PEER
+            if self.admission and not self.admission.admit(peername[0]):
+                if not self.ssl_context:
+                    try:
+                        client.send(self.admission.reject_message)
+                    except OSError:
+                        pass
+                client.close()
+                return
+            admitted = True
+            # The same plumbing asyncio.start_server uses, on a socket we've already looked at.
+            reader = asyncio.StreamReader()
+            protocol = asyncio.StreamReaderProtocol(reader)
+            try:
+                transport, _ = await loop.connect_accepted_socket(lambda: protocol, sock=client,
+                                                                  ssl=self.ssl_context)
+            except (OSError, asyncio.TimeoutError):
+                client.close()
+                self.release(None)
+                return
+        except asyncio.CancelledError:
+            # The listener stopped before the connection was handed over.
+            client.close()
+            if admitted:
+                self.release(None)
+            raise
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        self.start_telnet(reader, writer, peername)
+
+    def proxy_peer_trusted(self, address):
+        if not address:
+            return True
+        ip = ipaddress.ip_address(address[0].split("%", 1)[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        return any(ip in network for network in self.proxy_trusted)
+
+    def admit_telnet(self, reader, writer, peername):
+        if not peername:
+            peername = UNIX_PEER
+        if self.admission and not self.admission.admit(peername[0]):
+            writer.write(self.admission.reject_message)
+            writer.close()
+            return
+        self.start_telnet(reader, writer, peername)
+
+    def start_telnet(self, reader, writer, peername):
+        conn = TelnetMudConnection(self, reader, writer, peername=peername)
+        self.manager.connections.add(conn)
         conn.start()
 
     def accept_websocket(self, ws, path):
+        if self.admission and not self.admission.admit((ws.remote_address or UNIX_PEER)[0]):
+            return ws.close(code=1013, reason=self.admission.reject_message.decode().strip())
         conn = WebSocketConnection(self, ws, path)
+        self.manager.connections.add(conn)
         return conn.start()
 
+    def release(self, conn):
+        if self.admission:
+            self.admission.release()
+
 
 class MudLinkManager:
 
     def __init__(self):
         self.ssl_contexts = dict()
+        self.ssl_paths = dict()
         self.listeners = dict()
         self.pending = dict()
-        self.connections = dict()
+        self.connections = ConnectionRegistry()
         self.used = set()
         self.interfaces = {
             "localhost":  "127.0.0.1",
             "any": "0.0.0.0",
         }
         self.on_connect_cb = None
+        self.mssp = None
+        # Per-connection bound on commands waiting for the game. A full queue pauses that connection's reads.
+        self.inbound_limit = 100
+        # With run_sync_in_executor, plain (non-async) game callbacks run on executor (None meaning the loop's
+        # default) instead of blocking the event loop.
+        self.run_sync_in_executor = False
+        self.executor = None
+        # Capability changes within this many seconds are merged into one on_update_cb call.
+        self.update_delay = 0.1
+        # None unless profiling is enabled; checked before every timed stage.
+        self.profiler = None
+        # Precompressed static output, see TelnetMudConnection.send_static
+        self.static = StaticCache()
+        # Known client builds, for shortening negotiation. Set to None to always negotiate in full.
+        self.client_profiles = ClientProfileCache()
+        # Sockets passed in through socket activation, collected on first use.
+        self.inherited = None
 
-    def register_listener(self, name, interface, port, protocol, ssl_context=None):
+    def check_listener(self, name, protocol, ssl_context, proxy_protocol, proxy_trusted):
+        """
+        Validation shared by the register_*listener methods. Returns the SSLContext to use, if any.
+        """
         if name in self.listeners:
             raise ValueError(f"A Listener is already using name: {name}")
-        host = self.interfaces.get(interface, None)
-        if not host:
-            raise ValueError(f"Interface not registered: {interface}")
-        if port < 0 or port > 65535:
-            raise ValueError(f"Invalid port: {port}. Port must be number between 0 and 65535")
         if protocol.lower() not in ("telnet", "websocket"):
             raise ValueError(f"Unsupported protocol: {protocol}. Please pick telnet or websocket")
         ssl = self.ssl_contexts.get(ssl_context, None)
         if ssl_context and not ssl:
             raise ValueError(f"SSL Context not registered: {ssl_context}")
-        self.listeners[name] = MudListener(self, name, host, port, protocol.lower(), ssl_context=ssl)
+        if proxy_protocol and protocol.lower() != "telnet":
+            raise ValueError("The PROXY protocol is only supported on telnet listeners")
+        for network in proxy_trusted:
+            try:
+                ipaddress.ip_network(network)
+            except ValueError as e:
+                raise ValueError(f"Invalid trusted proxy network: {network} ({e})")
+        return ssl
+
+    def register_listener(self, name, interface, port, protocol, ssl_context=None, admission=None, capture=None,
+                          proxy_protocol=False, proxy_timeout=5.0, proxy_trusted=PROXY_TRUSTED):
+        ssl = self.check_listener(name, protocol, ssl_context, proxy_protocol, proxy_trusted)
+        host = self.interfaces.get(interface, None)
+        if not host:
+            raise ValueError(f"Interface not registered: {interface}")
+        if port < 0 or port > 65535:
+            raise ValueError(f"Invalid port: {port}. Port must be number between 0 and 65535")
+        self.listeners[name] = MudListener(self, name, host, port, protocol.lower(), ssl_context=ssl,
+                                           admission=admission, capture=capture, proxy_protocol=proxy_protocol,
+                                           proxy_timeout=proxy_timeout, proxy_trusted=proxy_trusted)
+
+    def register_unix_listener(self, name, path, protocol, ssl_context=None, admission=None, capture=None,
+                               proxy_protocol=False, proxy_timeout=5.0, proxy_trusted=PROXY_TRUSTED):
+        """
+        A listener on a Unix domain socket, e.g. behind a local reverse proxy. A stale socket file at path is
+        replaced, and the file is removed again when the listener stops.
+        """
+        ssl = self.check_listener(name, protocol, ssl_context, proxy_protocol, proxy_trusted)
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("Unix domain sockets are not supported on this platform")
+        self.listeners[name] = MudListener(self, name, None, None, protocol.lower(), ssl_context=ssl,
+                                           admission=admission, capture=capture, proxy_protocol=proxy_protocol,
+                                           proxy_timeout=proxy_timeout, proxy_trusted=proxy_trusted, path=path)
+
+    def register_inherited_listener(self, name, protocol, fd_name=None, ssl_context=None, admission=None,
+                                    capture=None, proxy_protocol=False, proxy_timeout=5.0, proxy_trusted=PROXY_TRUSTED):
+        """
+        A listener on a socket passed in by a service manager (systemd socket activation, see
+        activation.listen_fds). fd_name is the descriptor's name from LISTEN_FDNAMES, defaulting to the
+        listener name. If several descriptors share a name, each call takes the next one.
+        """
+        ssl = self.check_listener(name, protocol, ssl_context, proxy_protocol, proxy_trusted)
+        if self.inherited is None:
+            self.inherited = listen_fds()
+        socks = self.inherited.get(fd_name or name, None)
+        if not socks:
+            raise ValueError(f"No inherited socket named: {fd_name or name}")
+        sock = socks.pop(0)
+        interface, port = None, None
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            interface, port = sock.getsockname()[:2]
+        self.listeners[name] = MudListener(self, name, interface, port, protocol.lower(), ssl_context=ssl,
+                                           admission=admission, capture=capture, proxy_protocol=proxy_protocol,
+                                           proxy_timeout=proxy_timeout, proxy_trusted=proxy_trusted, sock=sock)
 
     def register_interface(self, name, interface):
-        pass
+        if name in self.interfaces:
+            raise ValueError(f"An Interface is already using name: {name}")
+        try:
+            # Hostnames are allowed too, but they must resolve now rather than when the listener binds.
+            socket.getaddrinfo(interface, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise ValueError(f"Invalid interface: {interface} ({e})")
+        self.interfaces[name] = interface
+
+    def register_ssl(self, name, pem_path, key_path=None, password=None):
+        if name in self.ssl_contexts:
+            raise ValueError(f"An SSL Context is already using name: {name}")
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        # Session tickets (stateless, survive across workers) and OpenSSL's server-side session cache (on by
+        # default for server contexts) let reconnecting clients resume instead of paying for a full handshake.
+        context.options &= ~ssl.OP_NO_TICKET
+        context.options |= ssl.OP_NO_COMPRESSION
+        if hasattr(context, "num_tickets"):
+            context.num_tickets = 2
+        context.load_cert_chain(pem_path, keyfile=key_path, password=password)
+        self.ssl_contexts[name] = context
+        self.ssl_paths[name] = (pem_path, key_path, password)
+        return context
+
+    def reload_ssl(self, name=None):
+        """
+        Reloads certificate chains from disk into the existing contexts. Listeners keep their context object,
+        so new handshakes pick up the new certificate without restarting anything.
+        """
+        names = [name] if name else list(self.ssl_contexts.keys())
+        for n in names:
+            if n not in self.ssl_contexts:
+                raise ValueError(f"SSL Context not registered: {n}")
+            pem_path, key_path, password = self.ssl_paths[n]
+            # Validate against a scratch context first so a bad file can't leave a live context half-loaded.
+            ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER).load_cert_chain(pem_path, keyfile=key_path, password=password)
+            self.ssl_contexts[n].load_cert_chain(pem_path, keyfile=key_path, password=password)
+
+    def register_mssp(self, variables, ttl=60.0):
+        self.mssp = MSSPProvider(variables, ttl=ttl)
+        return self.mssp
 
-    def register_ssl(self, name, pem_path):
-        pass
+    def register_static(self, key, data):
+        return self.static.register(key, data)
+
+    def enable_profiling(self):
+        if not self.profiler:
+            self.profiler = Profiler()
+        return self.profiler
+
+    def disable_profiling(self):
+        """
+        Stops profiling and returns the Profiler with what it gathered, if there was one.
+        """
+        profiler, self.profiler = self.profiler, None
+        return profiler
 
     def listen(self):
-        for k, v in self.listeners.items():
-            if not v.task:
-                v.task = asyncio.create_task(v.run())
+        """
+        Binds every listener, then starts them. Binding happens here rather than in the listener tasks so that
+        an address in use or a bad socket path raises immediately. If any listener fails to bind, the sockets
+        this call created are closed again, so listen() can simply be retried.
+        """
+        waiting = [v for v in self.listeners.values() if not v.running]
+        bound = list()
+        try:
+            for v in waiting:
+                if v.bind():
+                    bound.append(v)
+        except OSError:
+            for v in bound:
+                v.unbind()
+            raise
+        for v in waiting:
+            v.start()
 
     def stop(self):
         for k, v in self.listeners.items():
@@ -99,6 +457,9 @@ class MudLinkManager:
         while True:
             await asyncio.sleep(5)
 
+    def admission_metrics(self):
+        return {k: v.admission.export() for k, v in self.listeners.items() if v.admission}
+
     async def announce_conn(self, conn):
         if callable(self.on_connect_cb):
             if inspect.iscoroutinefunction(self.on_connect_cb):
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+# Per-window or per-connection details that say nothing about the client build.
+UNPROFILED = ("width", "height")
+
+
+class ClientProfile:
+    __slots__ = ("capabilities", "silent_local", "silent_remote", "hits")
+
+    def __init__(self, capabilities, silent_local, silent_remote):
+        self.capabilities = capabilities
+        self.silent_local = silent_local
+        self.silent_remote = silent_remote
+        self.hits = 0
+
+
+class ClientProfileCache:
+    """
+    Remembers, per client name and version from TTYPE stage 0, the capabilities that client ended up with
+    and the options it never answered, so the next connection from the same build can be predicted and
+    declared ready without waiting out its handshake.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.profiles = OrderedDict()
+
+    def get(self, name, version):
+        profile = self.profiles.get((name, version), None)
+        if profile:
+            self.profiles.move_to_end((name, version))
+            profile.hits += 1
+        return profile
+
+    def record(self, name, version, capabilities, silent_local=None, silent_remote=None):
+        """
+        Stores what a connection from this client negotiated. silent_local/silent_remote of None keep whatever
+        was recorded before.
+        """
+        caps = {k: v for k, v in capabilities.__dict__.items() if k not in UNPROFILED}
+        profile = self.profiles.get((name, version), None)
+        if profile:
+            profile.capabilities = caps
+            if silent_local is not None:
+                profile.silent_local = frozenset(silent_local)
+            if silent_remote is not None:
+                profile.silent_remote = frozenset(silent_remote)
+            self.profiles.move_to_end((name, version))
+            return profile
+        profile = ClientProfile(caps, frozenset(silent_local or ()), frozenset(silent_remote or ()))
+        self.profiles[(name, version)] = profile
+        if len(self.profiles) > self.size:
+            self.profiles.popitem(last=False)
+        return profile
+
+    def clear(self):
+        self.profiles.clear()
@@ -0,0 +1,72 @@
+import time
+
+perf_counter_ns = time.perf_counter_ns
+
+
+class Profiler:
+    """
+    Accumulates time spent per pipeline stage, attributed to listener, client name and connection.
+
+    Stages recorded by TelnetMudConnection:
+        parse - read_telnet(), excluding negotiation handled during it
+        negotiate - running option handler callbacks for a batch of negotiations
+        compress - MCCP2 zlib work in the writer
+        write / tls_write - handing bytes to the transport. For TLS connections this includes encryption.
+        callback - game callbacks run by the dispatch stage
+    TLS handshakes complete before a connection exists and aren't attributed.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        # (listener, client_name, connection, stage) -> [count, nanoseconds]
+        self.entries = dict()
+
+    def add(self, conn, stage, elapsed):
+        key = (conn.listener.name, conn.capabilities.client_name, conn.name, stage)
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.entries[key] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def clear(self):
+        self.entries.clear()
+        self.started = time.monotonic()
+
+    def totals(self, *fields):
+        """
+        Sums [count, nanoseconds] grouped by the given key fields: 0 listener, 1 client_name, 2 connection,
+        3 stage.
+        """
+        out = dict()
+        for key, (count, elapsed) in self.entries.items():
+            group = tuple(key[f] for f in fields)
+            entry = out.get(group, None)
+            if entry is None:
+                out[group] = [count, elapsed]
+            else:
+                entry[0] += count
+                entry[1] += elapsed
+        return out
+
+    def top(self, fields, n=10):
+        return sorted(self.totals(*fields).items(), key=lambda x: x[1][1], reverse=True)[:n]
+
+    def report(self, n=10):
+        lines = [f"Profile over {time.monotonic() - self.started:.1f}s"]
+        for title, fields in (("Stages", (3,)), ("Connections", (0, 1, 2)), ("Connection stages", (2, 3)),
+                              ("Clients", (1,))):
+            lines.append(f"Top {title}:")
+            for group, (count, elapsed) in self.top(fields, n):
+                lines.append(f"  {'/'.join(str(g) for g in group):<60} {elapsed / 1e6:>10.3f}ms {count:>8} calls")
+        return "\n".join(lines)
+
+    def dump_collapsed(self, path):
+        """
+        Writes a collapsed-stack file (listener;client;connection;stage microseconds) for flamegraph.pl and
+        compatible viewers.
+        """
+        with open(path, "w") as f:
+            for (listener, client, conn, stage), (count, elapsed) in self.entries.items():
+                f.write(f"{listener};{client};{conn};{stage} {elapsed // 1000}\n")
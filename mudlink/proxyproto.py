@@ -0,0 +1,199 @@
+"""
+HAProxy PROXY protocol (v1 text and v2 binary) support, so a listener behind a TCP load balancer sees the
+real client address.
+
+Running this module starts a stand-in proxy that adds the header, for trying a listener out locally:
+
+    python -m mudlink.proxyproto --listen 4001 --target 127.0.0.1:4000 --version 2
+"""
+import argparse
+import asyncio
+import ipaddress
+import socket
+import struct
+
+V1_PREFIX = b"PROXY "
+V1_MAX_LENGTH = 107
+V2_SIGNATURE = b"\r\n\r\n\x00\r\nQUIT\n"
+V2_HEADER = struct.Struct("!BBH")  # version/command, family/transport, address length
+V2_IPV4 = struct.Struct("!4s4sHH")
+V2_IPV6 = struct.Struct("!16s16sHH")
+V2_CMD_LOCAL = 0x0
+V2_CMD_PROXY = 0x1
+V2_AF_INET = 0x1
+V2_AF_INET6 = 0x2
+
+
+class ProxyProtocolError(ValueError):
+    pass
+
+
+def parse_v1(line):
+    """
+    Parses a full v1 header line, e.g. b"PROXY TCP4 1.2.3.4 5.6.7.8 1111 2222\\r\\n". Returns (host, port), or
+    None for UNKNOWN, meaning the real peer address should be used.
+    """
+    parts = line[:-2].split(b" ")
+    if len(parts) < 2 or parts[0] != b"PROXY":
+        raise ProxyProtocolError("Malformed PROXY v1 header")
+    if parts[1] == b"UNKNOWN":
+        return None
+    if parts[1] not in (b"TCP4", b"TCP6") or len(parts) != 6:
+        raise ProxyProtocolError("Malformed PROXY v1 header")
+    try:
+        host = str(ipaddress.ip_address(parts[2].decode("ascii")))
+        port = int(parts[4])
+    except ValueError:
+        raise ProxyProtocolError("Malformed PROXY v1 address")
+    if not 0 <= port <= 65535:
+        raise ProxyProtocolError("Malformed PROXY v1 port")
+    return host, port
+
+
+def parse_v2(command, family, body):
+    """
+    Parses the address block of a v2 header. Returns (host, port), or None when the real peer address should
+    be used (LOCAL connections such as health checks, or unsupported address families).
+    """
+    if command == V2_CMD_LOCAL:
+        return None
+    if command != V2_CMD_PROXY:
+        raise ProxyProtocolError(f"Unsupported PROXY v2 command: {command}")
+    if family == V2_AF_INET and len(body) >= V2_IPV4.size:
+        src, dst, sport, dport = V2_IPV4.unpack_from(body)
+        return socket.inet_ntop(socket.AF_INET, src), sport
+    if family == V2_AF_INET6 and len(body) >= V2_IPV6.size:
+        src, dst, sport, dport = V2_IPV6.unpack_from(body)
+        return socket.inet_ntop(socket.AF_INET6, src), sport
+    return None
+
+
+async def _wait_readable(loop, sock):
+    waiter = loop.create_future()
+    loop.add_reader(sock.fileno(), lambda: waiter.done() or waiter.set_result(None))
+    try:
+        await waiter
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+async def _recv(loop, sock, size, flags=0):
+    """
+    Receives up to size bytes, waiting for the socket to become readable if there are none yet.
+    """
+    while True:
+        try:
+            data = sock.recv(size, flags)
+        except (BlockingIOError, InterruptedError):
+            await _wait_readable(loop, sock)
+            continue
+        if not data:
+            raise ConnectionError("Connection closed before PROXY header")
+        return data
+
+
+async def _recv_exactly(loop, sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        buf += await _recv(loop, sock, size - len(buf))
+    return buf
+
+
+async def recv_proxy_header(loop, sock):
+    """
+    Consumes exactly one PROXY v1 or v2 header from a freshly accepted non-blocking socket. Only bytes known to
+    belong to the header are ever taken, so whatever follows, such as a TLS ClientHello, is left in the
+    kernel for the transport that takes over the socket. Returns (host, port), or None if the real peer
+    address should be used.
+    """
+    first = await _recv(loop, sock, 1, socket.MSG_PEEK)
+    if first == V2_SIGNATURE[:1]:
+        # A v2 header is always the 16 byte prefix plus the length it declares, so plain reads never overshoot.
+        head = await _recv_exactly(loop, sock, len(V2_SIGNATURE) + V2_HEADER.size)
+        if not head.startswith(V2_SIGNATURE):
+            raise ProxyProtocolError("Missing PROXY header")
+        ver_cmd, fam, length = V2_HEADER.unpack_from(head, len(V2_SIGNATURE))
+        if ver_cmd >> 4 != 2:
+            raise ProxyProtocolError("Unsupported PROXY v2 version")
+        body = await _recv_exactly(loop, sock, length)
+        return parse_v2(ver_cmd & 0xF, fam >> 4, memoryview(body))
+    if first != V1_PREFIX[:1]:
+        raise ProxyProtocolError("Missing PROXY header")
+    # A v1 header ends at the first CRLF. Everything before it is header too, so whatever a peek shows up to
+    # there is consumed, and the socket only becomes readable again once more arrives.
+    line = bytearray()
+    while True:
+        data = await _recv(loop, sock, V1_MAX_LENGTH - len(line), socket.MSG_PEEK)
+        end = (line[-1:] + data).find(b"\r\n")
+        if end != -1:
+            line += sock.recv(end + 2 - len(line[-1:]))
+            break
+        line += sock.recv(len(data))
+        if not V1_PREFIX.startswith(bytes(line[:len(V1_PREFIX)])):
+            raise ProxyProtocolError("Missing PROXY header")
+        if len(line) >= V1_MAX_LENGTH:
+            raise ProxyProtocolError("PROXY v1 header too long")
+    return parse_v1(bytes(line))
+
+
+def build_v1(src, dst):
+    family = b"TCP6" if ":" in src[0] else b"TCP4"
+    return b"PROXY %s %s %s %d %d\r\n" % (family, src[0].encode(), dst[0].encode(), src[1], dst[1])
+
+
+def build_v2(src, dst):
+    if ":" in src[0]:
+        fam, body = V2_AF_INET6, V2_IPV6.pack(socket.inet_pton(socket.AF_INET6, src[0]),
+                                              socket.inet_pton(socket.AF_INET6, dst[0]), src[1], dst[1])
+    else:
+        fam, body = V2_AF_INET, V2_IPV4.pack(socket.inet_pton(socket.AF_INET, src[0]),
+                                             socket.inet_pton(socket.AF_INET, dst[0]), src[1], dst[1])
+    # fam << 4 | 1: TCP over the given family.
+    return V2_SIGNATURE + V2_HEADER.pack(0x20 | V2_CMD_PROXY, (fam << 4) | 0x1, len(body)) + body
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def run_standin(listen_port, target_host, target_port, version=1, listen_host="127.0.0.1"):
+    """
+    A minimal stand-in for a load balancer: accepts connections and forwards them to the target, prefixed
+    with a PROXY header carrying the real client's address.
+    """
+    build = build_v2 if version == 2 else build_v1
+
+    async def handle(reader, writer):
+        src = writer.get_extra_info("peername")
+        dst = writer.get_extra_info("sockname")
+        up_reader, up_writer = await asyncio.open_connection(target_host, target_port)
+        up_writer.write(build(src[:2], dst[:2]))
+        await asyncio.gather(_pipe(reader, up_writer), _pipe(up_reader, writer))
+
+    server = await asyncio.start_server(handle, host=listen_host, port=listen_port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in PROXY protocol load balancer.")
+    parser.add_argument("--listen", type=int, required=True)
+    parser.add_argument("--target", required=True, help="host:port of the mudlink listener")
+    parser.add_argument("--version", type=int, choices=(1, 2), default=1)
+    args = parser.parse_args()
+    host, port = args.target.rsplit(":", 1)
+    asyncio.run(run_standin(args.listen, host, int(port), version=args.version))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+class ConnectionRegistry:
+    """
+    Every live connection, by name, with secondary indexes by listener, remote host, client name and each
+    capability flag that is currently on. Lookups are dict hits and iteration uses a cached snapshot tuple, so
+    "who" lists and per-IP counts never scan the whole table.
+
+    Connections are added when accepted, reindexed when they become ready and whenever their capabilities
+    change, and removed on disconnect.
+    """
+
+    def __init__(self):
+        self.connections = dict()
+        # Each index maps a key to a dict used as an insertion-ordered set: {name: connection}.
+        self.listeners = dict()
+        self.hosts = dict()
+        self.clients = dict()
+        self.flags = dict()
+        self.ready = dict()
+        # name -> (listener, host, client_name, flags, ready) as last indexed, so reindex only touches changes.
+        self.keys = dict()
+        self.snapshot_cache = None
+
+    @staticmethod
+    def index_keys(conn):
+        caps = conn.capabilities.__dict__
+        flags = frozenset(k for k, v in caps.items() if v is True)
+        return conn.listener.name, conn.host, conn.capabilities.client_name, flags, conn.ready
+
+    @staticmethod
+    def index_add(index, key, conn):
+        bucket = index.get(key, None)
+        if bucket is None:
+            index[key] = {conn.name: conn}
+        else:
+            bucket[conn.name] = conn
+
+    @staticmethod
+    def index_remove(index, key, name):
+        bucket = index.get(key, None)
+        if bucket is None:
+            return
+        bucket.pop(name, None)
+        if not bucket:
+            del index[key]
+
+    def add(self, conn):
+        if conn.name in self.connections:
+            raise ValueError(f"A Connection is already using name: {conn.name}")
+        self.connections[conn.name] = conn
+        self.snapshot_cache = None
+        self.index(conn, None)
+
+    def index(self, conn, old):
+        listener, host, client, flags, ready = new = self.index_keys(conn)
+        self.keys[conn.name] = new
+        if old is None:
+            self.index_add(self.listeners, listener, conn)
+            self.index_add(self.hosts, host, conn)
+            self.index_add(self.clients, client, conn)
+            for flag in flags:
+                self.index_add(self.flags, flag, conn)
+            if ready:
+                self.ready[conn.name] = conn
+            return
+        o_listener, o_host, o_client, o_flags, o_ready = old
+        if host != o_host:
+            self.index_remove(self.hosts, o_host, conn.name)
+            self.index_add(self.hosts, host, conn)
+        if client != o_client:
+            self.index_remove(self.clients, o_client, conn.name)
+            self.index_add(self.clients, client, conn)
+        for flag in o_flags - flags:
+            self.index_remove(self.flags, flag, conn.name)
+        for flag in flags - o_flags:
+            self.index_add(self.flags, flag, conn)
+        if ready and not o_ready:
+            self.ready[conn.name] = conn
+        elif o_ready and not ready:
+            self.ready.pop(conn.name, None)
+
+    def reindex(self, conn):
+        """
+        Brings a connection's index entries up to date with its host, capabilities and ready state.
+        """
+        old = self.keys.get(conn.name, None)
+        if old is None:
+            return
+        if self.index_keys(conn) != old:
+            self.index(conn, old)
+
+    def remove(self, conn):
+        return self.pop(conn.name, None)
+
+    def pop(self, name, default=None):
+        conn = self.connections.pop(name, None)
+        if conn is None:
+            return default
+        self.snapshot_cache = None
+        listener, host, client, flags, ready = self.keys.pop(name)
+        self.index_remove(self.listeners, listener, name)
+        self.index_remove(self.hosts, host, name)
+        self.index_remove(self.clients, client, name)
+        for flag in flags:
+            self.index_remove(self.flags, flag, name)
+        self.ready.pop(name, None)
+        return conn
+
+    def get(self, name, default=None):
+        return self.connections.get(name, default)
+
+    def __contains__(self, name):
+        return name in self.connections
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def snapshot(self):
+        """
+        An immutable tuple of all connections, rebuilt only after one is added or removed. Safe to iterate while
+        connections come and go.
+        """
+        if self.snapshot_cache is None:
+            self.snapshot_cache = tuple(self.connections.values())
+        return self.snapshot_cache
+
+    def by_listener(self, name):
+        return tuple(self.listeners.get(name, dict()).values())
+
+    def by_host(self, host):
+        return tuple(self.hosts.get(host, dict()).values())
+
+    def by_client(self, client_name):
+        return tuple(self.clients.get(client_name, dict()).values())
+
+    def with_flag(self, flag):
+        return tuple(self.flags.get(flag, dict()).values())
+
+    def ready_connections(self):
+        return tuple(self.ready.values())
+
+    def count_host(self, host):
+        return len(self.hosts.get(host, ()))
+
+    def find(self, listener=None, host=None, client_name=None, flags=(), ready=None):
+        """
+        Connections matching every given criterion. Starts from the smallest matching index and filters that,
+        so the cost follows the size of the answer rather than the number of connections.
+        """
+        candidates = list()
+        if listener is not None:
+            candidates.append(self.listeners.get(listener, dict()))
+        if host is not None:
+            candidates.append(self.hosts.get(host, dict()))
+        if client_name is not None:
+            candidates.append(self.clients.get(client_name, dict()))
+        for flag in flags:
+            candidates.append(self.flags.get(flag, dict()))
+        if ready:
+            candidates.append(self.ready)
+        if not candidates:
+            if ready is False:
+                return tuple(c for c in self.snapshot() if not c.ready)
+            return self.snapshot()
+        candidates.sort(key=len)
+        smallest, rest = candidates[0], candidates[1:]
+        return tuple(c for name, c in smallest.items() if all(name in other for other in rest)
+                     and (ready is not False or not c.ready))
+
+    def counts(self):
+        """
+        Connection counts per listener and per client, for status displays.
+        """
+        return {
+            "total": len(self.connections),
+            "ready": len(self.ready),
+            "listeners": {k: len(v) for k, v in self.listeners.items()},
+            "clients": {k: len(v) for k, v in self.clients.items()},
+        }
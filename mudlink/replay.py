@@ -0,0 +1,131 @@
+"""
+Replays a capture log made by a MudListener with capture enabled, feeding each connection's inbound bytes
+through TelnetMudConnection's parser and negotiation, and its outbound bytes through the output path
+(including MCCP2, if the replayed client negotiated it). Nothing touches the network.
+
+    python -m mudlink.replay capture.log [--realtime]
+
+Negotiation replies are regenerated from the inbound stream, so they appear on top of the captured
+outbound traffic.
+"""
+import argparse
+import asyncio
+import time
+
+from .capture import read_capture, KIND_OPEN, KIND_IN, KIND_OUT, KIND_CLOSE
+from .mudlink import MudLinkManager, MudListener
+from .mudconnection import LANE_TEXT
+from .telnet import TelnetMudConnection
+
+
+class ReplayWriter:
+
+    def __init__(self):
+        self.written = 0
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return ("replay", 0)
+        return default
+
+    def write(self, data):
+        self.written += len(data)
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def drain(self):
+        pass
+
+
+class ReplayStats:
+
+    def __init__(self):
+        self.connections = 0
+        self.records = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bytes_wire = 0
+        self.elapsed = 0.0
+
+    def report(self):
+        rate = (self.bytes_in + self.bytes_out) / self.elapsed / 1048576 if self.elapsed else 0.0
+        return (f"{self.connections} connections, {self.records} records, {self.bytes_in} bytes in, "
+                f"{self.bytes_out} bytes out ({self.bytes_wire} on the wire) in {self.elapsed:.3f}s "
+                f"({rate:.2f} MiB/s)")
+
+
+def drain_output(conn):
+    while any(conn.lanes) or conn.bulk or conn.text_splices or conn.compress_at >= 0:
+        conn.flush_output()
+    # There's no game here; discard parsed commands between records.
+    while not conn.inbound.empty():
+        conn.inbound.get_nowait()
+
+
+async def replay(path, realtime=False):
+    manager = MudLinkManager()
+    # Nothing consumes inbound while a record is parsed, so one big read must not be able to fill the queue.
+    manager.inbound_limit = 0
+    listener = MudListener(manager, "replay", "replay", 0, "telnet")
+    stats = ReplayStats()
+    conns = dict()
+    first = None
+    start = time.perf_counter()
+
+    for stamp, cid, kind, data in read_capture(path):
+        stats.records += 1
+        if realtime:
+            if first is None:
+                first = stamp
+            delay = (stamp - first) - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        if kind == KIND_OPEN:
+            conn = TelnetMudConnection(listener, None, ReplayWriter())
+            conn.running = True
+            conns[cid] = conn
+            stats.connections += 1
+            continue
+
+        conn = conns.get(cid, None)
+        if not conn:
+            continue
+        if kind == KIND_IN:
+            stats.bytes_in += len(data)
+            await conn.receive(data)
+        elif kind == KIND_OUT:
+            stats.bytes_out += len(data)
+            conn.queue_bytes(data, lane=LANE_TEXT)
+        elif kind == KIND_CLOSE:
+            drain_output(conn)
+            stats.bytes_wire += conn.writer.written
+            del conns[cid]
+            continue
+        drain_output(conn)
+
+    for conn in conns.values():
+        drain_output(conn)
+        stats.bytes_wire += conn.writer.written
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a mudlink capture log offline.")
+    parser.add_argument("path")
+    parser.add_argument("--realtime", action="store_true", help="Honor the captured timestamps.")
+    args = parser.parse_args()
+    stats = asyncio.run(replay(args.path, realtime=args.realtime))
+    print(stats.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import zlib
+
+ADLER_BASE = 65521
+
+
+def adler32_combine(adler1, adler2, len2):
+    """
+    The adler32 of two concatenated buffers, from each one's adler32 and the second one's length. This is
+    zlib's adler32_combine(), which Python's zlib module doesn't expose.
+    """
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xffff) + ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + ADLER_BASE - rem
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum2 >= (ADLER_BASE << 1):
+        sum2 -= (ADLER_BASE << 1)
+    if sum2 >= ADLER_BASE:
+        sum2 -= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+class StaticBlob:
+    """
+    Telnet-ready static output, also deflated once into a self-contained raw deflate block sequence that
+    ends on a full flush. Because it references nothing before or after itself, the compressed form can be
+    spliced into any MCCP2 stream right after that stream's own full flush.
+    """
+    __slots__ = ("key", "plain", "compressed", "adler", "length")
+
+    def __init__(self, key, data, level=9):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        # IAC must be doubled, exactly as TelnetMudConnection.send_bytes would do.
+        self.key = key
+        self.plain = bytes(data).replace(b"\xff", b"\xff\xff")
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.compressed = compressor.compress(self.plain) + compressor.flush(zlib.Z_FULL_FLUSH)
+        self.adler = zlib.adler32(self.plain)
+        self.length = len(self.plain)
+
+
+class StaticCache:
+    """
+    Named StaticBlobs, so hot output like login banners, the MOTD or common help pages is compressed once
+    per process instead of once per connection.
+    """
+
+    def __init__(self, level=9):
+        self.level = level
+        self.blobs = dict()
+
+    def register(self, key, data):
+        blob = StaticBlob(key, data, level=self.level)
+        self.blobs[key] = blob
+        return blob
+
+    def get(self, key):
+        return self.blobs.get(key, None)
+
+    def remove(self, key):
+        self.blobs.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.blobs
@@ -1,7 +1,12 @@
 import asyncio
+import struct
 import zlib
-import inspect
-from .mudconnection import MudConnection
+from collections import deque
+from .mudconnection import MudConnection, Capabilities, LANE_CONTROL, LANE_OOB, LANE_TEXT, LANE_BULK, BULK_CHUNK
+from .mssp import encode_mssp
+from .capture import KIND_IN, KIND_OUT, KIND_CLOSE
+from .profiling import perf_counter_ns
+from .splice import StaticBlob, adler32_combine
 from typing import Dict
 
 
@@ -49,25 +54,70 @@ class _TC:
 
 
 NEGOTIATORS = (_TC.WILL, _TC.WONT, _TC.DO, _TC.DONT)
-ACK_OPPOSITES = {_TC.WILL: _TC.DO, _TC.DO: _TC.WILL}
-NEG_OPPOSITES = {_TC.WILL: _TC.DONT, _TC.DO: _TC.WONT}
 
-
-class TelnetOutMessage:
-    def __init__(self, data):
-        self.data = data
-        self.enable_compress2 = False
-        self.close = False
-
-
-class TelnetOptionPerspective:
-
-    def __init__(self, owner):
-        self.owner = owner
-        self.enabled = False
-        self.negotiating = False
-        self.heard_answer = False
-        self.asked = False
+# RFC 1143 "Q method" option states. Each side of each option is one byte in a bytearray(256) on the
+# connection: the low bits are the state and Q_OPPOSITE is the single-entry request queue.
+Q_NO = 0
+Q_YES = 1
+Q_WANTNO = 2
+Q_WANTYES = 3
+Q_OPPOSITE = 4
+
+# Events produced by a transition, dispatched to the option handler once the batch is done.
+EV_NONE = 0
+EV_ENABLE = 1
+EV_DISABLE = 2
+EV_REFUSED = 3
+
+
+def _q_transition(positive, state, supported):
+    queued = state & Q_OPPOSITE
+    state &= 3
+    if positive:
+        # WILL received about the remote side, or DO about the local side.
+        if state == Q_NO:
+            return (Q_YES, True, EV_ENABLE) if supported else (Q_NO, False, EV_NONE)
+        if state == Q_YES:
+            return Q_YES, None, EV_NONE
+        if state == Q_WANTNO:
+            # DONT answered by WILL. Either way, no reply.
+            return (Q_YES, None, EV_NONE) if queued else (Q_NO, None, EV_DISABLE)
+        # Q_WANTYES
+        return (Q_WANTNO, False, EV_NONE) if queued else (Q_YES, None, EV_ENABLE)
+    # WONT received about the remote side, or DONT about the local side.
+    if state == Q_NO:
+        return Q_NO, None, EV_NONE
+    if state == Q_YES:
+        return Q_NO, False, EV_DISABLE
+    if state == Q_WANTNO:
+        return (Q_WANTYES, True, EV_NONE) if queued else (Q_NO, None, EV_DISABLE)
+    # Q_WANTYES
+    return Q_NO, None, EV_REFUSED
+
+
+# Indexed by (positive << 4) | (state << 1) | supported.
+Q_TABLE = tuple(_q_transition(p, st, su) for p in (0, 1) for st in range(8) for su in (0, 1))
+
+# Every possible 3-byte negotiation frame, built once. NEG_FRAMES[cmd][option]
+NEG_FRAMES = {cmd: tuple(bytes([_TC.IAC, cmd, op]) for op in range(256)) for cmd in NEGOTIATORS}
+
+# For a received command: (affects local side, is positive, reply for agree, reply for refuse)
+NEG_RULES = {
+    _TC.WILL: (False, 1, _TC.DO, _TC.DONT),
+    _TC.WONT: (False, 0, _TC.DO, _TC.DONT),
+    _TC.DO: (True, 1, _TC.WILL, _TC.WONT),
+    _TC.DONT: (True, 0, _TC.WILL, _TC.WONT),
+}
+
+
+# Fixed frames, built once.
+FRAME_NOP = bytes([_TC.IAC, _TC.NOP])
+FRAME_GA = bytes([_TC.IAC, _TC.GA])
+FRAME_EOR = bytes([_TC.IAC, _TC.EOR])
+FRAME_SB = bytes([_TC.IAC, _TC.SB])
+FRAME_SE = bytes([_TC.IAC, _TC.SE])
+FRAME_IAC = bytes([_TC.IAC])
+IAC_DOUBLED = bytes([_TC.IAC, _TC.IAC])
 
 
 class TelnetHandshakeHolder:
@@ -84,6 +134,8 @@ class TelnetHandshakeHolder:
 
 class TelnetOptionHandler:
     opcode = 0
+    # The Capabilities field this option turns on, if any.
+    capability = None
     support_local = False
     support_remote = False
     start_will = False
@@ -94,73 +146,18 @@ class TelnetOptionHandler:
 
     def __init__(self, owner):
         self.owner = owner
-        self.local = TelnetOptionPerspective(self)
-        self.remote = TelnetOptionPerspective(self)
+
+    @property
+    def local_enabled(self):
+        return self.owner.us[self.opcode] & 3 == Q_YES
+
+    @property
+    def remote_enabled(self):
+        return self.owner.him[self.opcode] & 3 == Q_YES
 
     async def subnegotiate(self, data):
         pass
 
-    async def negotiate(self, cmd):
-        if cmd == _TC.WILL:
-            if self.support_remote:
-                if self.remote.negotiating:
-                    self.remote.negotiating = False
-                    if not self.remote.enabled:
-                        self.remote.enabled = True
-                        await self.owner.send_negotiate(_TC.DO, self.opcode)
-                        await self.enable_remote()
-                        if self.opcode in self.owner.handshakes.remote:
-                            self.owner.handshakes.remote.remove(self.opcode)
-                            await self.owner.check_ready()
-                else:
-                    self.remote.enabled = True
-                    await self.owner.send_negotiate(_TC.DO, self.opcode)
-                    await self.enable_remote()
-                    if self.opcode in self.owner.handshakes.remote:
-                        self.owner.handshakes.remote.remove(self.opcode)
-                        await self.owner.check_ready()
-            else:
-                await self.owner.send_negotiate(_TC.DONT, self.opcode)
-
-        elif cmd == _TC.DO:
-            if self.support_local:
-                if self.local.negotiating:
-                    self.local.negotiating = False
-                    if not self.local.enabled:
-                        self.local.enabled = True
-                        await self.owner.send_negotiate(_TC.WILL, self.opcode)
-                        await self.enable_local()
-                        if self.opcode in self.owner.handshakes.local:
-                            self.owner.handshakes.local.remove(self.opcode)
-                            await self.owner.check_ready()
-                else:
-                    self.local.enabled = True
-                    await self.owner.send_negotiate(_TC.WILL, self.opcode)
-                    await self.enable_local()
-                    if self.opcode in self.owner.handshakes.local:
-                        self.owner.handshakes.local.remove(self.opcode)
-                        await self.owner.check_ready()
-            else:
-                await self.owner.send_negotiate(_TC.DONT, self.opcode)
-
-        elif cmd == _TC.WONT:
-            if self.remote.enabled:
-                await self.disable_remote()
-                if self.remote.negotiating:
-                    self.remote.negotiating = False
-                    if self.opcode in self.owner.handshakes.remote:
-                        self.owner.handshakes.remote.remove(self.opcode)
-                    await self.owner.check_ready()
-
-        elif cmd == _TC.DONT:
-            if self.local.enabled:
-                await self.disable_remote()
-                if self.local.negotiating:
-                    self.local.negotiating = False
-                    if self.opcode in self.owner.handshakes.local:
-                        self.owner.handshakes.local.remove(self.opcode)
-                    await self.owner.check_ready()
-
     async def enable_local(self):
         pass
 
@@ -176,6 +173,7 @@ class TelnetOptionHandler:
 
 class MCCP2Handler(TelnetOptionHandler):
     opcode = _TC.MCCP2
+    capability = "mccp2"
     support_local = True
     start_will = True
     hs_local = [opcode]
@@ -187,7 +185,7 @@ class MCCP2Handler(TelnetOptionHandler):
 
     async def disable_local(self):
         self.owner.capabilities.mccp2 = False
-        self.owner.out_compress = None
+        self.owner.end_compression()
         await self.owner.on_update()
 
 
@@ -226,16 +224,20 @@ class TTYPEHandler(TelnetOptionHandler):
         self.owner.capabilities.mtts = False
         await self.owner.on_update()
 
+    def finish_stage(self, *stages):
+        for code in stages:
+            self.owner.handshakes.special.discard(code)
+
     async def subnegotiate(self, data):
         if data == self.previous:
             # we're not going to learn anything new from this client...
-            for code in self.hs_special:
-                if code in self.owner.handshakes.special:
-                    self.owner.handshakes.special.remove(code)
+            self.finish_stage(*self.hs_special)
             self.previous = None
             await self.owner.check_ready()
+            self.owner.record_profile()
+            return
 
-        if data[0] == 0:
+        if data and data[0] == 0:
             self.previous = data
             data = data[1:]
             data = data.decode(errors='ignore')
@@ -245,14 +247,22 @@ class TTYPEHandler(TelnetOptionHandler):
             if self.stage == 0:
                 await self.receive_stage_0(data)
                 self.stage = 1
+                self.finish_stage(0)
                 await self.request()
+                # A known client may be predicted, and declared ready, from its name alone.
+                await self.owner.apply_profile()
             elif self.stage == 1:
                 await self.receive_stage_1(data)
                 self.stage = 2
+                self.finish_stage(1)
+                await self.request()
             elif self.stage == 2:
                 await self.receive_stage_2(data)
                 self.stage = 3
+                self.finish_stage(2)
+                self.owner.record_profile()
             await self.owner.on_update()
+            await self.owner.check_ready()
 
     async def receive_stage_0(self, data):
         # Code adapted from Evennia! Credit where credit is due.
@@ -324,11 +334,15 @@ class TTYPEHandler(TelnetOptionHandler):
             if option.isdigit():
                 # a number - determine the actual capabilities
                 option = int(option)
-                for k, v in {capability: True for bitval, capability in self.mtts if option & bitval > 0}:
-                    if k == "truecolor" and v:
-                        self.owner.capabilities.color = 3
+                for bitval, capability in self.mtts:
+                    if not option & bitval:
+                        continue
+                    if capability == "xterm256":
+                        self.owner.capabilities.color = max(self.owner.capabilities.color, 2)
+                    elif capability == "ansi":
+                        self.owner.capabilities.color = max(self.owner.capabilities.color, 1)
                     else:
-                        setattr(self.owner.capabilities, k, v)
+                        setattr(self.owner.capabilities, capability, True)
             else:
                 # some clients send erroneous MTTS as a string. Add directly.
                 self.owner.capabilities.mtts = True
@@ -366,6 +380,7 @@ class MCCP3Handler(TelnetOptionHandler):
 
 class NAWSHandler(TelnetOptionHandler):
     opcode = _TC.NAWS
+    capability = "naws"
     support_remote = True
     start_do = True
 
@@ -373,11 +388,15 @@ class NAWSHandler(TelnetOptionHandler):
         self.owner.capabilities.naws = True
         await self.owner.on_update()
 
+    async def disable_remote(self):
+        self.owner.capabilities.naws = False
+        await self.owner.on_update()
+
     async def subnegotiate(self, data):
         if len(data) >= 4:
             # NAWS is negotiated with 16bit words
             new_width = int.from_bytes(data[0:2], byteorder="big", signed=False)
-            new_height = int.from_bytes(data[2:2], byteorder="big", signed=False)
+            new_height = int.from_bytes(data[2:4], byteorder="big", signed=False)
             changed = False
             if new_width != self.owner.capabilities.width or new_height != self.owner.capabilities.height:
                 changed = True
@@ -389,6 +408,7 @@ class NAWSHandler(TelnetOptionHandler):
 
 class SGAHandler(TelnetOptionHandler):
     opcode = _TC.SGA
+    capability = "suppress_ga"
     start_will = True
     support_local = True
 
@@ -403,6 +423,7 @@ class SGAHandler(TelnetOptionHandler):
 
 class LinemodeHandler(TelnetOptionHandler):
     opcode = _TC.LINEMODE
+    capability = "linemode"
     start_do = True
     support_remote = True
 
@@ -417,6 +438,7 @@ class LinemodeHandler(TelnetOptionHandler):
 
 class MSSPHandler(TelnetOptionHandler):
     opcode = _TC.MSSP
+    capability = "mssp"
     start_will = True
     support_local = True
 
@@ -426,6 +448,10 @@ class MSSPHandler(TelnetOptionHandler):
 
     async def enable_local(self):
         self.owner.capabilities.mssp = True
+        # Answer crawlers straight away from the manager's cache, rather than waiting for the game.
+        provider = self.owner.listener.manager.mssp
+        if provider:
+            self.owner.queue_bytes(provider.get_telnet(), lane=LANE_OOB)
         await self.owner.on_update()
 
     async def disable_local(self):
@@ -433,45 +459,81 @@ class MSSPHandler(TelnetOptionHandler):
         await self.owner.on_update()
 
     async def send(self, data: Dict[str, str]):
-        out = bytearray([_TC.IAC, _TC.SB, self.opcode])
-        for k, v in data.items():
-            out += 1
-            out += bytes(k)
-            out += 2
-            out += bytes(v)
-        out.extend([_TC.IAC, _TC.SE])
-        await self.owner.outbox.put(TelnetOutMessage(out))
+        self.owner.queue_bytes(encode_mssp(data), lane=LANE_OOB)
+
+
+class EORHandler(TelnetOptionHandler):
+    opcode = _TC.TELOPT_EOR
+    capability = "eor"
+    start_will = True
+    support_local = True
+
+    async def enable_local(self):
+        self.owner.capabilities.eor = True
+        await self.owner.on_update()
+
+    async def disable_local(self):
+        self.owner.capabilities.eor = False
+        await self.owner.on_update()
+
+
+def escape_iac(data):
+    """
+    Doubles IAC bytes. bytes or bytearray without any are returned as-is, without a copy.
+    """
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if data.find(_TC.IAC) == -1:
+        return data
+    return data.replace(FRAME_IAC, IAC_DOUBLED)
 
 
 class TelnetMudConnection(MudConnection):
-    handler_classes = [MCCP2Handler, TTYPEHandler, NAWSHandler, SGAHandler, LinemodeHandler, MSSPHandler]
+    handler_classes = [MCCP2Handler, TTYPEHandler, NAWSHandler, SGAHandler, LinemodeHandler, MSSPHandler,
+                       EORHandler]
 
-    def __init__(self, listener, reader, writer):
+    def __init__(self, listener, reader, writer, peername=None):
         super().__init__(listener)
         self.reader = reader
         self.writer = writer
         self.inbox = bytearray()
         self.cmdbuff = bytearray()
-        self.outbox = asyncio.Queue()
+        self.lanes = [bytearray(), bytearray(), bytearray()]
+        self.bulk = deque()
+        self.out_event = asyncio.Event()
+        self.compress_at = -1
+        self.out_adler = 1
+        self.out_spliced = False
+        # (offset into the text lane, StaticBlob) for static output queued between text.
+        self.text_splices = list()
+        self.us = bytearray(256)
+        self.him = bytearray(256)
+        self.supported_local = bytearray(256)
+        self.supported_remote = bytearray(256)
+        self.neg_events = list()
+        # Time spent in negotiation, enqueueing and handlers during one receive(), kept out of the parse stage.
+        self.handoff_ns = 0
         self.handlers = {hc.opcode: hc(self) for hc in self.handler_classes}
         self.out_compressor = None
         self.in_compress = None
         self.handshakes = TelnetHandshakeHolder(self)
-        self.host, self.host_port = self.writer.get_extra_info('peername')
-        self.backlog = list()
+        self.predicted = False
+        self.timers = list()
+        # peername may come from a PROXY header rather than the socket. IPv6 peernames have 4 fields.
+        if peername is None:
+            peername = self.writer.get_extra_info('peername')
+        self.host, self.host_port = peername[0], peername[1]
 
         for k, v in self.handlers.items():
+            self.supported_local[k] = v.support_local
+            self.supported_remote[k] = v.support_remote
             if v.start_will:
-                msg = TelnetOutMessage(bytearray([_TC.IAC, _TC.WILL, k]))
-                self.outbox.put_nowait(msg)
-                v.local.negotiating = True
-                v.local.asked = True
+                self.us[k] = Q_WANTYES
+                self.queue_bytes(NEG_FRAMES[_TC.WILL][k])
 
             if v.start_do:
-                msg = TelnetOutMessage(bytearray([_TC.IAC, _TC.DO, k]))
-                self.outbox.put_nowait(msg)
-                v.remote.negotiating = True
-                v.remote.asked = True
+                self.him[k] = Q_WANTYES
+                self.queue_bytes(NEG_FRAMES[_TC.DO][k])
 
             if v.hs_local:
                 self.handshakes.local.update(v.hs_local)
@@ -480,6 +542,9 @@ class TelnetMudConnection(MudConnection):
             if v.hs_special:
                 self.handshakes.special.update(v.hs_special)
 
+        self.capture = listener.capture
+        self.capture_id = self.capture.open(self) if self.capture else 0
+
     async def check_ready(self):
         if self.ready:
             return
@@ -488,61 +553,254 @@ class TelnetMudConnection(MudConnection):
         await self.on_ready()
 
     async def on_ready(self):
+        # Nothing here awaits before ready is set, so the handshake and run_timer() can't both get through.
+        if self.ready or not self.running:
+            return
+        if not self.predicted:
+            # Whatever is still outstanding now is what this client doesn't answer.
+            self.record_profile(self.handshakes.local, self.handshakes.remote)
         await super().on_ready()
-        for (operation, data) in self.backlog:
-            if operation == "command":
-                await self.forward_command(data)
-            elif operation == "oob":
-                await self.forward_oob(data)
-        self.backlog.clear()
+
+    async def apply_profile(self):
+        """
+        Looks up the client named in TTYPE stage 0. If it's been seen before, capabilities not yet learned are
+        filled in from its profile and the handshake stops waiting on the TTYPE stages and the options that
+        client never answers. Options it has already refused are left alone, and negotiation carries on as
+        normal, so a refusal that arrives later still switches the predicted capability back off.
+        """
+        cache = self.listener.manager.client_profiles
+        if self.ready or not cache:
+            return
+        profile = cache.get(self.capabilities.client_name, self.capabilities.client_version)
+        if not profile:
+            return
+        self.predicted = True
+        defaults = Capabilities().__dict__
+        # Options this client already refused stay off, whatever the profile says.
+        refused = {h.capability for h in self.handlers.values()
+                   if h.capability and (self.us if h.support_local else self.him)[h.opcode] & 3 == Q_NO}
+        for k, v in profile.capabilities.items():
+            if k not in refused and getattr(self.capabilities, k, None) == defaults.get(k, None):
+                setattr(self.capabilities, k, v)
+        self.handshakes.local.difference_update(profile.silent_local)
+        self.handshakes.remote.difference_update(profile.silent_remote)
+        self.handshakes.special.clear()
+        await self.check_ready()
+
+    def record_profile(self, silent_local=None, silent_remote=None):
+        cache = self.listener.manager.client_profiles
+        if not cache or self.capabilities.client_name == "UNKNOWN":
+            return
+        cache.record(self.capabilities.client_name, self.capabilities.client_version, self.capabilities,
+                     silent_local=silent_local, silent_remote=silent_remote)
 
     async def run_timer(self):
         await asyncio.sleep(0.3)
         await self.on_ready()
 
     async def run(self):
-        await self.listener.manager.announce_conn(self)
-        await asyncio.gather(self.read(), self.write(), self.keepalive(), self.run_timer())
+        self.start_dispatch()
+        self.timers = [asyncio.create_task(self.keepalive()), asyncio.create_task(self.run_timer())]
+        try:
+            await asyncio.gather(self.read(), self.write())
+        finally:
+            self.shutdown()
+            self.release()
+
+    def shutdown(self):
+        """
+        Stops everything run() started once the socket is finished with, whichever way that happened: the
+        writer is closed, write() is woken up to notice, and the timers are cancelled.
+        """
+        self.running = False
+        self.out_event.set()
+        for task in self.timers:
+            task.cancel()
+        self.timers = list()
+        self.writer.close()
 
     async def keepalive(self):
         while self.running:
             if self.capabilities.keepalive:
-                msg = TelnetOutMessage(bytearray([_TC.IAC, _TC.NOP]))
-                await self.outbox.put(msg)
+                self.queue_bytes(FRAME_NOP)
             await asyncio.sleep(30)
 
     async def read(self):
         while self.running:
-            data = await self.reader.read(4096)
+            try:
+                data = await self.reader.read(4096)
+            except OSError:
+                # Resets, broken pipes and TLS errors (ssl.SSLError is an OSError) end the connection like EOF.
+                data = b""
             if len(data):
-                if self.in_compress:
-                    data = self.in_compress.decompress(data)
-                self.inbox += data
-                await self.read_telnet()
+                await self.receive(data)
             else:
-                self.running = False
+                self.end_capture()
+                self.shutdown()
                 await self.on_disconnect()
 
+    async def receive(self, data):
+        if self.capture_id:
+            self.capture.record(self.capture_id, KIND_IN, data)
+        if self.in_compress:
+            data = self.in_compress.decompress(data)
+        self.inbox += data
+        prof = self.listener.manager.profiler
+        if prof:
+            self.handoff_ns = 0
+            start = perf_counter_ns()
+            await self.read_telnet()
+            prof.add(self, "parse", perf_counter_ns() - start - self.handoff_ns)
+        else:
+            await self.read_telnet()
+        if self.neg_events:
+            await self.process_negotiation()
+
     async def write(self):
         while self.running:
-            msg = await self.outbox.get()
-            data = msg.data
+            await self.out_event.wait()
+            if not self.running:
+                break
+            if not self.bulk:
+                self.out_event.clear()
+            self.flush_output()
+            if self.running:
+                try:
+                    await self.writer.drain()
+                except ConnectionError:
+                    self.running = False
+
+    def flush_output(self):
+        """
+        Writes one round of output: everything pending in the control, OOB and text lanes, in that order,
+        followed by at most one bulk chunk.
+        """
+        lanes = self.lanes
+        pieces = list()
+        for i, data in enumerate(lanes):
             if data:
-                if self.out_compressor:
-                    data = self.out_compressor.compress(data) + self.out_compressor.flush(zlib.Z_SYNC_FLUSH)
-                self.writer.write(data)
-            if msg.enable_compress2 and not self.out_compressor:
+                lanes[i] = bytearray()
+                if i == LANE_TEXT and self.text_splices:
+                    self.expand_splices(data, pieces)
+                else:
+                    pieces.append(data)
+        if self.text_splices:
+            # Static output queued while the text lane was empty.
+            self.expand_splices(b"", pieces)
+        if self.compress_at >= 0:
+            # Everything after IAC SB MCCP2 IAC SE is compressed. That frame always sits in the control lane.
+            start, self.compress_at = self.compress_at, -1
+            view = memoryview(pieces[0])
+            self.write_data([view[:start]])
+            if not self.out_compressor:
                 self.out_compressor = zlib.compressobj(9)
-            if msg.close and self.writer.can_write_eof():
-                self.running = False
-                if self.out_compressor:
-                    self.writer.write(self.out_compressor.flush(zlib.Z_FINISH))
-                self.writer.write_eof()
+                self.out_adler = 1
+            pieces[0] = view[start:]
+        if self.bulk:
+            pieces.append(self.bulk.popleft())
+            self.check_bulk_drained()
+        self.write_data(pieces)
+        if self.closing and not self.bulk:
+            self.running = False
+            self.bulk_drained.set()
+            self.finish_compression()
+            self.end_capture()
+            self.writer.close()
+
+    def finish_compression(self):
+        """
+        Writes the end of the MCCP2 stream, after which the client reads plain bytes again.
+        """
+        if not self.out_compressor:
+            return
+        tail = self.out_compressor.flush(zlib.Z_FINISH)
+        if self.out_spliced:
+            # zlib's own trailer only covers what it compressed itself.
+            tail = tail[:-4] + struct.pack(">I", self.out_adler)
+        self.writer.write(tail)
+        self.out_compressor = None
+        self.out_spliced = False
+
+    def end_compression(self):
+        """
+        Stops MCCP2 at the client's request. Output already queued, including the WONT answering its DONT, was
+        produced while compression was on, so it goes out compressed before the stream is finished.
+        """
+        if self.compress_at < 0 and not self.out_compressor:
+            return
+        if any(self.lanes) or self.text_splices or self.compress_at >= 0:
+            self.flush_output()
+        self.finish_compression()
+
+    def expand_splices(self, text, pieces):
+        """
+        Adds the text lane's bytes to pieces, cut up around the StaticBlobs queued within it.
+        """
+        splices, self.text_splices = self.text_splices, list()
+        view = memoryview(text)
+        last = 0
+        for offset, blob in splices:
+            if offset > last:
+                pieces.append(view[last:offset])
+            pieces.append(blob)
+            last = offset
+        if last < len(text):
+            pieces.append(view[last:])
+
+    def write_data(self, pieces):
+        if self.capture_id:
+            for data in pieces:
+                if isinstance(data, StaticBlob):
+                    data = data.plain
+                if data:
+                    self.capture.record(self.capture_id, KIND_OUT, data)
+        prof = self.listener.manager.profiler
+        if prof:
+            start = perf_counter_ns()
+        if self.out_compressor:
+            compressor = self.out_compressor
+            out = bytearray()
+            dirty = False
+            adler = self.out_adler
+            for data in pieces:
+                if isinstance(data, StaticBlob):
+                    # Full flush resets our compressor's history and byte-aligns the stream, so the blob's
+                    # self-contained blocks can follow directly.
+                    out += compressor.flush(zlib.Z_FULL_FLUSH)
+                    out += data.compressed
+                    adler = adler32_combine(adler, data.adler, data.length)
+                    self.out_spliced = True
+                    dirty = False
+                elif data:
+                    out += compressor.compress(data)
+                    adler = zlib.adler32(data, adler)
+                    dirty = True
+            self.out_adler = adler
+            if dirty:
+                out += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if prof:
+                now = perf_counter_ns()
+                prof.add(self, "compress", now - start)
+                start = now
+            if out:
+                self.writer.write(out)
+        else:
+            for data in pieces:
+                if isinstance(data, StaticBlob):
+                    data = data.plain
+                if data:
+                    self.writer.write(data)
+        if prof:
+            prof.add(self, "tls_write" if self.tls else "write", perf_counter_ns() - start)
+
+    def end_capture(self):
+        if self.capture_id:
+            self.capture.record(self.capture_id, KIND_CLOSE)
+            self.capture_id = 0
 
     async def close(self):
-        msg = TelnetOutMessage(bytearray())
-        msg.close = True
-        await self.outbox.put(msg)
+        self.closing = True
+        self.out_event.set()
 
     async def read_telnet(self):
         while len(self.inbox) > 0:
@@ -560,7 +818,7 @@ class TelnetMudConnection(MudConnection):
                         if len(self.inbox) > 2:
                             cmd, option = self.inbox[1], self.inbox[2]
                             del self.inbox[0:3]
-                            await self.negotiate(cmd, option)
+                            self.negotiate(cmd, option)
                             continue
                         else:
                             # it's a negotiation, but we need more.
@@ -577,7 +835,9 @@ class TelnetMudConnection(MudConnection):
                             option = self.inbox[2]
                             data = self.inbox[3:idx]
                             del self.inbox[:idx + 2]
-                            await self.subnegotiate(option, data)
+                            if self.neg_events:
+                                await self.process_negotiation()
+                            await self.handoff(self.subnegotiate(option, data))
                             continue
                         else:
                             # it's a subnegotiate, but we need more.
@@ -585,10 +845,14 @@ class TelnetMudConnection(MudConnection):
                     else:
                         cmd = self.inbox[1]
                         del self.inbox[0:2]
-                        await self.handle_command(cmd)
+                        if self.neg_events:
+                            await self.process_negotiation()
+                        await self.handoff(self.handle_command(cmd))
                         continue
             else:
                 # we are dealing with 'just data!'
+                if self.neg_events:
+                    await self.process_negotiation()
                 idx = self.inbox.find(_TC.IAC)
                 if idx == -1:
                     # no idx. consume entire remaining buffer.
@@ -603,6 +867,20 @@ class TelnetMudConnection(MudConnection):
                     await self.read_command()
                     continue
 
+    async def handoff(self, awaitable):
+        """
+        Awaits work read_telnet hands off - a possibly full inbound queue, subnegotiation handlers and the
+        callbacks they run - so the profiler's parse stage only counts parsing.
+        """
+        prof = self.listener.manager.profiler
+        if not prof:
+            return await awaitable
+        start = perf_counter_ns()
+        try:
+            return await awaitable
+        finally:
+            self.handoff_ns += perf_counter_ns() - start
+
     async def handle_command(self, cmd):
         if cmd == _TC.NOP:
             return
@@ -615,33 +893,111 @@ class TelnetMudConnection(MudConnection):
             found = self.cmdbuff[:idx]
             if found.endswith(b'\r'):
                 del found[-1]
-            if self.ready:
-                await self.forward_command(found)
-            else:
-                self.backlog.append(('command', found))
             del self.cmdbuff[:idx + 1]
-
-    async def forward_command(self, data):
-        if data and callable(self.on_command_cb):
-            if inspect.iscoroutinefunction(self.on_command_cb):
-                await self.on_command_cb(self, data)
-            else:
-                self.on_command_cb(self, data)
-
-    async def forward_oob(self, data):
-        if data and callable(self.on_oob_cb):
-            if inspect.iscoroutinefunction(self.on_oob_cb):
-                await self.on_oob_cb(self, data)
-            else:
-                self.on_oob_cb(self, data)
-
-    async def negotiate(self, cmd, option):
-        handler = self.handlers.get(option, None)
-        if handler:
-            await handler.negotiate(cmd)
+            if not self.ready and found == b"MSSP-REQUEST" and self.listener.manager.mssp:
+                await self.handoff(self.answer_mssp_request())
+                return
+            await self.handoff(self.enqueue("command", found))
+
+    async def answer_mssp_request(self):
+        # Plain-text crawler convention. The game never hears about this connection.
+        self.queue_bytes(self.listener.manager.mssp.get_text(), lane=LANE_TEXT)
+        await self.close()
+
+    def negotiate(self, cmd, option):
+        """
+        Applies one received negotiation to the option state tables. Any reply is appended to the pending
+        output buffer; handler callbacks are deferred to process_negotiation() so a burst of negotiations
+        from one read costs no awaits.
+        """
+        local, positive, agree, refuse = NEG_RULES[cmd]
+        if local:
+            states, supported = self.us, self.supported_local
+        else:
+            states, supported = self.him, self.supported_remote
+        state, reply, event = Q_TABLE[(positive << 4) | (states[option] << 1) | supported[option]]
+        states[option] = state
+        if reply is not None:
+            self.queue_bytes(NEG_FRAMES[agree if reply else refuse][option])
+        if event:
+            self.neg_events.append((option, local, event))
+
+    async def process_negotiation(self):
+        prof = self.listener.manager.profiler
+        if prof:
+            start = perf_counter_ns()
+            await self.run_negotiation()
+            elapsed = perf_counter_ns() - start
+            self.handoff_ns += elapsed
+            prof.add(self, "negotiate", elapsed)
         else:
-            response = NEG_OPPOSITES.get(cmd, None)
-            await self.send_negotiate(response, option)
+            await self.run_negotiation()
+
+    async def run_negotiation(self):
+        events, self.neg_events = self.neg_events, list()
+        check = False
+        for option, local, event in events:
+            handler = self.handlers.get(option, None)
+            if not handler:
+                continue
+            if event == EV_ENABLE:
+                await (handler.enable_local() if local else handler.enable_remote())
+            elif event == EV_DISABLE or (event == EV_REFUSED and self.predicted):
+                # A prediction may have switched the option's capability on before the client refused it.
+                await (handler.disable_local() if local else handler.disable_remote())
+            pending = self.handshakes.local if local else self.handshakes.remote
+            if option in pending:
+                pending.remove(option)
+                check = True
+        if check:
+            await self.check_ready()
+
+    def queue_bytes(self, data, lane=LANE_CONTROL):
+        """
+        Appends already-escaped telnet bytes to a lane's pending output buffer.
+        """
+        self.lanes[lane] += data
+        self.out_event.set()
+
+    def queue_escaped(self, data, lane=LANE_TEXT):
+        """
+        Appends data to a lane, doubling any IAC bytes. The common case of no IAC costs a single scan of what
+        was appended; only data that contains one is copied again. LANE_BULK data is split into chunks.
+        """
+        if lane == LANE_BULK:
+            self.queue_bulk(data)
+            return
+        buf = self.lanes[lane]
+        start = len(buf)
+        buf += data
+        if buf.find(_TC.IAC, start) != -1:
+            buf[start:] = buf[start:].replace(FRAME_IAC, IAC_DOUBLED)
+        self.out_event.set()
+
+    def queue_bulk(self, data):
+        """
+        Queues data on the bulk lane in BULK_CHUNK sized pieces. The chunks are views into one buffer until
+        they're written, so only bytes is shared with the caller; anything mutable is copied first, or a caller
+        reusing its buffer would change (or be unable to resize) output that's already queued.
+        """
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        data = escape_iac(data)
+        view = memoryview(data)
+        total = len(data)
+        start = 0
+        while start < total:
+            end = min(start + BULK_CHUNK, total)
+            if end < total and data[end - 1] == _TC.IAC:
+                # Don't split a doubled IAC across chunks, another lane may be written between them.
+                j = end - 1
+                while j >= start and data[j] == _TC.IAC:
+                    j -= 1
+                if (end - 1 - j) % 2:
+                    end += 1
+            self.bulk.append(view[start:end])
+            start = end
+        self.out_event.set()
 
     async def subnegotiate(self, option, data):
         handler = self.handlers.get(option, None)
@@ -649,21 +1005,62 @@ class TelnetMudConnection(MudConnection):
             await handler.subnegotiate(data)
 
     async def send_negotiate(self, cmd, option):
-        msg = TelnetOutMessage(bytearray([_TC.IAC, cmd, option]))
-        await self.outbox.put(msg)
-
-    async def send_subnegotiate(self, cmd, data):
-        out = bytearray([_TC.IAC, _TC.SB, cmd])
-        out.extend(data)
-        out.extend([_TC.IAC, _TC.SE])
-        msg = TelnetOutMessage(out)
-        if cmd == _TC.MCCP2:
-            msg.enable_compress2 = True
-        await self.outbox.put(msg)
+        self.queue_bytes(NEG_FRAMES[cmd][option])
 
-    async def send_bytes(self, data):
-        if self.capabilities.suppress_ga:
-            msg = TelnetOutMessage(data)
+    async def send_subnegotiate(self, cmd, data, lane=LANE_CONTROL):
+        if cmd == _TC.MCCP2:
+            lane = LANE_CONTROL
+        buf = self.lanes[lane]
+        buf += FRAME_SB
+        buf.append(cmd)
+        self.queue_escaped(bytes(data) if isinstance(data, list) else data, lane=lane)
+        self.queue_bytes(FRAME_SE, lane=lane)
+        if cmd == _TC.MCCP2:
+            self.compress_at = len(buf)
+
+    async def send_bytes(self, data, lane=LANE_TEXT):
+        """
+        Queues str, bytes, bytearray or memoryview data as text for the client. str is encoded as UTF-8.
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.queue_escaped(data, lane=lane)
+
+    def bulk_pending(self):
+        return len(self.bulk)
+
+    async def send_static(self, blob, lane=LANE_TEXT):
+        """
+        Queues a StaticBlob, or the key of one in the manager's static cache, on the text or bulk lane. Under
+        MCCP2 its precompressed form is spliced into the stream instead of compressing it again.
+        """
+        if not isinstance(blob, StaticBlob):
+            found = self.listener.manager.static.get(blob)
+            if not found:
+                raise ValueError(f"Static output not registered: {blob}")
+            blob = found
+        if lane == LANE_BULK:
+            self.bulk.append(blob)
         else:
-            msg = TelnetOutMessage(data + _TC.GA)
-        await self.outbox.put(msg)
+            self.text_splices.append((len(self.lanes[LANE_TEXT]), blob))
+        self.out_event.set()
+
+    async def send_bulk(self, data):
+        await self.send_bytes(data, lane=LANE_BULK)
+
+    async def send_text(self, text, lane=LANE_TEXT):
+        await self.send_bytes(text, lane=lane)
+
+    async def send_prompt(self, text):
+        """
+        Queues a prompt on the text lane, marked with EOR if the client agreed to it, or GA unless it's being
+        suppressed.
+        """
+        await self.send_bytes(text, lane=LANE_TEXT)
+        if self.capabilities.eor:
+            self.queue_bytes(FRAME_EOR, lane=LANE_TEXT)
+        elif not self.capabilities.suppress_ga:
+            self.queue_bytes(FRAME_GA, lane=LANE_TEXT)
+
+    async def send_nop(self):
+        self.queue_bytes(FRAME_NOP)
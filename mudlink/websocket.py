@@ -1,5 +1,6 @@
 import asyncio
-from . mudconnection import MudConnection
+from collections import deque
+from . mudconnection import MudConnection, LANE_TEXT, LANE_BULK, LANE_COUNT, BULK_CHUNK
 from websockets.exceptions import ConnectionClosedError, ConnectionClosed, ConnectionClosedOK
 
 
@@ -9,7 +10,8 @@ class WebSocketConnection(MudConnection):
         super().__init__(listener)
         self.connection = ws
         self.path = path
-        self.outbox = asyncio.Queue()
+        self.lanes = [deque() for _ in range(LANE_COUNT)]
+        self.out_event = asyncio.Event()
 
     def start(self):
         if not self.running:
@@ -17,7 +19,10 @@ class WebSocketConnection(MudConnection):
             return self.run()
 
     async def run(self):
-        await asyncio.gather(self.read(), self.write())
+        try:
+            await asyncio.gather(self.read(), self.write())
+        finally:
+            self.release()
 
     async def read(self):
         try:
@@ -28,12 +33,53 @@ class WebSocketConnection(MudConnection):
         except ConnectionClosedOK:
             self.running = False
         except ConnectionClosed:
-            self.running = False
+            pass
+        self.running = False
+        # Wake write() so it notices, or run() never finishes.
+        self.out_event.set()
+        await self.on_disconnect()
 
     async def write(self):
         while self.running:
-            msg = await self.outbox.get()
-            await self.connection.send(msg)
+            await self.out_event.wait()
+            if not self.running:
+                break
+            msg = self.next_message()
+            if msg is None:
+                self.out_event.clear()
+                continue
+            try:
+                await self.connection.send(msg)
+            except ConnectionClosed:
+                self.running = False
+
+    def next_message(self):
+        for i, lane in enumerate(self.lanes):
+            if lane:
+                msg = lane.popleft()
+                if i == LANE_BULK:
+                    self.check_bulk_drained()
+                return msg
+        return None
+
+    def bulk_pending(self):
+        return len(self.lanes[LANE_BULK])
+
+    async def send_bulk(self, data):
+        self.queue(data, lane=LANE_BULK)
+
+    def queue(self, msg, lane=LANE_TEXT):
+        """
+        Queues a websocket message on an output lane. Bulk messages longer than BULK_CHUNK are sent as several
+        messages, so higher lanes can be sent between them.
+        """
+        if lane == LANE_BULK and len(msg) > BULK_CHUNK:
+            target = self.lanes[lane]
+            for i in range(0, len(msg), BULK_CHUNK):
+                target.append(msg[i:i + BULK_CHUNK])
+        else:
+            self.lanes[lane].append(msg)
+        self.out_event.set()
 
     async def process(self, msg):
         pass
\ No newline at end of file
@@ -61,14 +61,14 @@ setup(
     
     """,
     long_description_content_type="text/markdown",
-    packages=find_packages(),
+    packages=find_packages(exclude=("tests", "tests.*")),
     install_requires=get_requirements(),
     package_data={"": package_data()},
     zip_safe=False,
     classifiers=[
 
     ],
-    python_requires=">=3.7",
+    python_requires=">=3.8",
     project_urls={
         "Source": "https://github.com/volundmush/mudlink-python",
         "Issue tracker": "https://github.com/volundmush/mudlink-python/issues",
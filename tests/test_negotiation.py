@@ -0,0 +1,71 @@
+import unittest
+
+from mudlink.mudlink import MudLinkManager, MudListener
+from mudlink.replay import ReplayWriter
+from mudlink.telnet import (TelnetMudConnection, Q_TABLE, Q_NO, Q_YES, Q_WANTNO, Q_WANTYES, Q_OPPOSITE, EV_NONE, EV_ENABLE, EV_DISABLE,
+                            EV_REFUSED)
+
+AGREE = True
+REFUSE = False
+SILENT = None
+
+
+def transition(positive, state, supported=1):
+    return Q_TABLE[(positive << 4) | (state << 1) | supported]
+
+
+class TestQMethod(unittest.TestCase):
+    """
+    The receive side of RFC 1143 section 7. "positive" is WILL (or DO for our own side), negative WONT/DONT.
+    Replies are AGREE (DO/WILL), REFUSE (DONT/WONT) or SILENT.
+    """
+
+    def test_positive(self):
+        self.assertEqual(transition(1, Q_NO), (Q_YES, AGREE, EV_ENABLE))
+        self.assertEqual(transition(1, Q_NO, supported=0), (Q_NO, REFUSE, EV_NONE))
+        self.assertEqual(transition(1, Q_YES), (Q_YES, SILENT, EV_NONE))
+        # "DONT answered by WILL": an error, the option ends up off.
+        self.assertEqual(transition(1, Q_WANTNO), (Q_NO, SILENT, EV_DISABLE))
+        self.assertEqual(transition(1, Q_WANTNO | Q_OPPOSITE), (Q_YES, SILENT, EV_NONE))
+        self.assertEqual(transition(1, Q_WANTYES), (Q_YES, SILENT, EV_ENABLE))
+        self.assertEqual(transition(1, Q_WANTYES | Q_OPPOSITE), (Q_WANTNO, REFUSE, EV_NONE))
+
+    def test_negative(self):
+        self.assertEqual(transition(0, Q_NO), (Q_NO, SILENT, EV_NONE))
+        self.assertEqual(transition(0, Q_YES), (Q_NO, REFUSE, EV_DISABLE))
+        self.assertEqual(transition(0, Q_WANTNO), (Q_NO, SILENT, EV_DISABLE))
+        self.assertEqual(transition(0, Q_WANTNO | Q_OPPOSITE), (Q_WANTYES, AGREE, EV_NONE))
+        self.assertEqual(transition(0, Q_WANTYES), (Q_NO, SILENT, EV_REFUSED))
+        self.assertEqual(transition(0, Q_WANTYES | Q_OPPOSITE), (Q_NO, SILENT, EV_REFUSED))
+
+    def test_never_loops(self):
+        # A request we didn't make is only ever answered once, whatever the peer keeps sending.
+        for positive in (0, 1):
+            for supported in (0, 1):
+                state, reply, _ = transition(positive, Q_NO, supported)
+                again = transition(positive, state, supported)
+                if reply is not None and state == (Q_YES if positive else Q_NO):
+                    self.assertIsNone(again[1])
+
+
+class TestHandlerCapabilities(unittest.IsolatedAsyncioTestCase):
+
+    async def test_disable_clears_capability(self):
+        # Every capability an option switches on has to come off again when the option is turned off.
+        listener = MudListener(MudLinkManager(), "test", "test", 0, "telnet")
+        conn = TelnetMudConnection(listener, None, ReplayWriter(), peername=("127.0.0.1", 0))
+        handlers = [h for h in conn.handlers.values() if h.capability]
+        self.assertTrue(handlers)
+        for handler in handlers:
+            with self.subTest(handler=type(handler).__name__):
+                self.assertTrue(handler.support_local or handler.support_remote)
+                setattr(conn.capabilities, handler.capability, True)
+                if handler.support_local:
+                    await handler.disable_local()
+                else:
+                    await handler.disable_remote()
+                self.assertIs(getattr(conn.capabilities, handler.capability), False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+
+from mudlink.mudconnection import BULK_CHUNK, LANE_TEXT, LANE_BULK
+from mudlink.mudlink import MudLinkManager, MudListener
+from mudlink.replay import ReplayWriter
+from mudlink.telnet import TelnetMudConnection, escape_iac
+
+IAC = 0xFF
+
+
+def leading_run(chunk):
+    n = 0
+    while n < len(chunk) and chunk[n] == IAC:
+        n += 1
+    return n
+
+
+def trailing_run(chunk):
+    n = 0
+    while n < len(chunk) and chunk[len(chunk) - 1 - n] == IAC:
+        n += 1
+    return n
+
+
+class TestEscapeIAC(unittest.TestCase):
+
+    def test_no_iac_is_not_copied(self):
+        data = b"hello"
+        self.assertIs(escape_iac(data), data)
+
+    def test_doubles(self):
+        self.assertEqual(escape_iac(b"\xff"), b"\xff\xff")
+        self.assertEqual(escape_iac(b"a\xff\xffb"), b"a\xff\xff\xff\xffb")
+        self.assertEqual(escape_iac(bytearray(b"\xffx")), b"\xff\xffx")
+
+    def test_memoryview(self):
+        self.assertEqual(escape_iac(memoryview(b"x\xffy")[1:]), b"\xff\xffy")
+
+
+class TestQueueing(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        listener = MudListener(MudLinkManager(), "test", "test", 0, "telnet")
+        self.conn = TelnetMudConnection(listener, None, ReplayWriter(), peername=("127.0.0.1", 0))
+        # Drop the opening negotiation.
+        self.conn.lanes = [bytearray() for _ in self.conn.lanes]
+
+    def bulk(self):
+        chunks = [bytes(c) for c in self.conn.bulk]
+        self.conn.bulk.clear()
+        return chunks
+
+    def test_queue_escaped(self):
+        self.conn.queue_escaped(b"a\xffb", lane=LANE_TEXT)
+        self.conn.queue_escaped(memoryview(b"\xff\xff"), lane=LANE_TEXT)
+        self.conn.queue_escaped(bytearray(b"c"), lane=LANE_TEXT)
+        self.assertEqual(self.conn.lanes[LANE_TEXT], b"a\xff\xffb\xff\xff\xff\xffc")
+
+    async def test_send_bytes_str(self):
+        await self.conn.send_bytes("hé", lane=LANE_TEXT)
+        self.assertEqual(self.conn.lanes[LANE_TEXT], "hé".encode("utf-8"))
+
+    def test_bulk_keeps_doubled_iac_together(self):
+        # IAC runs of several lengths starting just before, on and after the chunk boundary.
+        for run in (1, 2, 3, 5):
+            for before in range(BULK_CHUNK - 6, BULK_CHUNK + 2):
+                data = b"a" * before + b"\xff" * run + b"z" * (BULK_CHUNK + 10)
+                self.conn.queue_bulk(data)
+                chunks = self.bulk()
+                self.assertEqual(b"".join(chunks), escape_iac(data))
+                for chunk in chunks:
+                    self.assertLessEqual(len(chunk), BULK_CHUNK + 1)
+                    self.assertEqual(leading_run(chunk) % 2, 0, (run, before))
+                    self.assertEqual(trailing_run(chunk) % 2, 0, (run, before))
+
+    def test_bulk_all_iac(self):
+        data = b"\xff" * (BULK_CHUNK + 1)
+        self.conn.queue_bulk(data)
+        chunks = self.bulk()
+        self.assertEqual(b"".join(chunks), data * 2)
+        self.assertTrue(all(len(c) % 2 == 0 for c in chunks))
+
+    def test_bulk_copies_mutable_input(self):
+        buf = bytearray(b"A" * 10)
+        self.conn.queue_escaped(buf, lane=LANE_BULK)
+        buf[:] = b"C" * 5
+        buf.extend(b"more")
+        view_source = bytearray(b"B" * 10)
+        self.conn.queue_bulk(memoryview(view_source))
+        view_source[0] = ord("X")
+        self.assertEqual(self.bulk(), [b"A" * 10, b"B" * 10])
+
+    async def test_send_bulk_str(self):
+        await self.conn.send_bulk("ÿ")
+        self.assertEqual(self.bulk(), [b"\xc3\xbf"])
+
+
+if __name__ == "__main__":
+    unittest.main()
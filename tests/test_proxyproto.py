@@ -0,0 +1,143 @@
+import asyncio
+import socket
+import unittest
+
+from mudlink.mudlink import MudLinkManager, MudListener
+from mudlink.proxyproto import (parse_v1, parse_v2, recv_proxy_header, build_v1, build_v2, ProxyProtocolError,
+                                V2_SIGNATURE, V2_HEADER, V2_CMD_LOCAL, V2_AF_INET)
+
+SRC4, DST4 = ("192.0.2.10", 40000), ("198.51.100.1", 4000)
+SRC6, DST6 = ("2001:db8::5", 4444), ("2001:db8::1", 23)
+
+
+class TestParseV1(unittest.TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(parse_v1(build_v1(SRC4, DST4)), SRC4)
+        self.assertEqual(parse_v1(build_v1(SRC6, DST6)), SRC6)
+
+    def test_unknown(self):
+        self.assertIsNone(parse_v1(b"PROXY UNKNOWN\r\n"))
+        self.assertIsNone(parse_v1(b"PROXY UNKNOWN 1.2.3.4 5.6.7.8 1 2\r\n"))
+
+    def test_malformed(self):
+        for line in (b"PROXY\r\n", b"PROXY TCP4 1.2.3.4\r\n", b"PROXY UDP4 1.2.3.4 5.6.7.8 1 2\r\n",
+                     b"PROXY TCP4 999.2.3.4 5.6.7.8 1 2\r\n", b"PROXY TCP4 1.2.3.4 5.6.7.8 x 2\r\n",
+                     b"PROXY TCP4 1.2.3.4 5.6.7.8 70000 2\r\n", b"GET / HTTP/1.0\r\n"):
+            with self.assertRaises(ProxyProtocolError, msg=line):
+                parse_v1(line)
+
+
+class TestParseV2(unittest.TestCase):
+
+    def split(self, header):
+        ver_cmd, fam, length = V2_HEADER.unpack_from(header, len(V2_SIGNATURE))
+        body = header[len(V2_SIGNATURE) + V2_HEADER.size:]
+        self.assertEqual(len(body), length)
+        return ver_cmd & 0xF, fam >> 4, body
+
+    def test_round_trip(self):
+        self.assertEqual(parse_v2(*self.split(build_v2(SRC4, DST4))), SRC4)
+        self.assertEqual(parse_v2(*self.split(build_v2(SRC6, DST6))), SRC6)
+
+    def test_local_and_unsupported(self):
+        self.assertIsNone(parse_v2(V2_CMD_LOCAL, V2_AF_INET, b""))
+        # AF_UNIX addresses fall back to the socket's peer.
+        self.assertIsNone(parse_v2(1, 0x3, b"\x00" * 216))
+        with self.assertRaises(ProxyProtocolError):
+            parse_v2(0x2, V2_AF_INET, b"")
+
+    def test_short_body(self):
+        self.assertIsNone(parse_v2(1, V2_AF_INET, b"\x00" * 4))
+
+
+class TestRecvProxyHeader(unittest.IsolatedAsyncioTestCase):
+
+    async def receive(self, *chunks):
+        """
+        Feeds chunks through a socketpair with a pause between them, then returns the parsed address and
+        whatever recv_proxy_header left on the socket.
+        """
+        loop = asyncio.get_running_loop()
+        server, client = socket.socketpair()
+        server.setblocking(False)
+        try:
+            async def feed():
+                for chunk in chunks:
+                    client.sendall(chunk)
+                    await asyncio.sleep(0.01)
+                client.shutdown(socket.SHUT_WR)
+
+            feeder = asyncio.create_task(feed())
+            address = await asyncio.wait_for(recv_proxy_header(loop, server), 2)
+            await feeder
+            rest = b""
+            while True:
+                data = await loop.sock_recv(server, 4096)
+                if not data:
+                    break
+                rest += data
+            return address, rest
+        finally:
+            server.close()
+            client.close()
+
+    async def test_v1_leaves_trailing_data(self):
+        header = build_v1(SRC4, DST4)
+        self.assertEqual(await self.receive(header + b"\x16\x03\x01hello"), (SRC4, b"\x16\x03\x01hello"))
+
+    async def test_v1_split(self):
+        header = build_v1(SRC6, DST6)
+        cr = header.index(b"\r")
+        # Split between CR and LF, and within the prefix.
+        chunks = (header[:3], header[3:cr + 1], header[cr + 1:] + b"look\r\n")
+        self.assertEqual(await self.receive(*chunks), (SRC6, b"look\r\n"))
+
+    async def test_v2_split(self):
+        header = build_v2(SRC6, DST6)
+        chunks = tuple(header[i:i + 7] for i in range(0, len(header), 7)) + (b"after",)
+        self.assertEqual(await self.receive(*chunks), (SRC6, b"after"))
+
+    async def test_rejects(self):
+        for data in (b"GET / HTTP/1.0\r\n\r\n", b"PROXY " + b"1" * 200, b"\r\n\r\n\x00\r\nQUIX\n" + b"\x00" * 4,
+                     V2_SIGNATURE + V2_HEADER.pack(0x11, 0x11, 0)):
+            with self.assertRaises(ProxyProtocolError, msg=data):
+                await self.receive(data)
+
+    async def test_closed_early(self):
+        with self.assertRaises(ConnectionError):
+            await self.receive(b"PROXY TCP4 1.2")
+
+
+class TestTrustedPeers(unittest.TestCase):
+
+    def listener(self, **kwargs):
+        return MudListener(MudLinkManager(), "test", "test", 0, "telnet", proxy_protocol=True, **kwargs)
+
+    def test_default_is_loopback(self):
+        listener = self.listener()
+        self.assertTrue(listener.proxy_peer_trusted(("127.0.0.1", 5000)))
+        self.assertTrue(listener.proxy_peer_trusted(("::1", 5000, 0, 0)))
+        self.assertTrue(listener.proxy_peer_trusted(("::ffff:127.0.0.1", 5000, 0, 0)))
+        self.assertFalse(listener.proxy_peer_trusted(SRC4))
+        self.assertFalse(listener.proxy_peer_trusted(SRC6 + (0, 0)))
+
+    def test_networks(self):
+        listener = self.listener(proxy_trusted=("192.0.2.0/24", "2001:db8::/32"))
+        self.assertTrue(listener.proxy_peer_trusted(SRC4))
+        self.assertFalse(listener.proxy_peer_trusted(("fe80::1%eth0", 1, 0, 2)))
+        self.assertTrue(listener.proxy_peer_trusted(SRC6 + (0, 0)))
+        self.assertFalse(listener.proxy_peer_trusted(("127.0.0.1", 5000)))
+
+    def test_unix_peers(self):
+        self.assertTrue(self.listener(proxy_trusted=()).proxy_peer_trusted(""))
+
+    def test_invalid_network(self):
+        manager = MudLinkManager()
+        manager.register_interface("local", "127.0.0.1")
+        with self.assertRaises(ValueError):
+            manager.register_listener("test", "local", 0, "telnet", proxy_protocol=True, proxy_trusted=("10.0.0.1/8",))
+
+
+if __name__ == "__main__":
+    unittest.main()
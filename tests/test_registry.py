@@ -0,0 +1,145 @@
+import unittest
+from types import SimpleNamespace
+
+from mudlink.mudconnection import Capabilities
+from mudlink.registry import ConnectionRegistry
+
+
+def make_conn(name, listener="telnet", host="192.0.2.1", client_name="UNKNOWN", ready=False, **flags):
+    caps = Capabilities()
+    caps.client_name = client_name
+    for flag, value in flags.items():
+        setattr(caps, flag, value)
+    return SimpleNamespace(name=name, listener=SimpleNamespace(name=listener), host=host, capabilities=caps,
+                           ready=ready)
+
+
+def names(conns):
+    return sorted(c.name for c in conns)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.reg = ConnectionRegistry()
+
+    def assertConsistent(self):
+        """
+        Rebuilds every index from scratch and compares it with the incremental one.
+        """
+        expected = ConnectionRegistry()
+        for conn in self.reg.connections.values():
+            expected.add(conn)
+        for index in ("listeners", "hosts", "clients", "flags"):
+            self.assertEqual({k: set(v) for k, v in getattr(self.reg, index).items()},
+                             {k: set(v) for k, v in getattr(expected, index).items()}, index)
+        self.assertEqual(set(self.reg.ready), set(expected.ready))
+        self.assertEqual(self.reg.keys, expected.keys)
+
+    def test_add_and_duplicate(self):
+        self.reg.add(make_conn("a"))
+        self.assertIn("a", self.reg)
+        self.assertEqual(len(self.reg), 1)
+        with self.assertRaises(ValueError):
+            self.reg.add(make_conn("a"))
+        self.assertConsistent()
+
+    def test_reindex(self):
+        conn = make_conn("a")
+        other = make_conn("b")
+        self.reg.add(conn)
+        self.reg.add(other)
+        conn.host = "192.0.2.2"
+        conn.capabilities.client_name = "MUDLET"
+        conn.capabilities.mccp2 = True
+        conn.capabilities.suppress_ga = False
+        conn.ready = True
+        self.reg.reindex(conn)
+        self.assertConsistent()
+        self.assertEqual(names(self.reg.by_host("192.0.2.1")), ["b"])
+        self.assertEqual(names(self.reg.by_host("192.0.2.2")), ["a"])
+        self.assertEqual(names(self.reg.by_client("MUDLET")), ["a"])
+        self.assertEqual(names(self.reg.with_flag("mccp2")), ["a"])
+        self.assertEqual(names(self.reg.with_flag("suppress_ga")), ["b"])
+        self.assertEqual(names(self.reg.ready_connections()), ["a"])
+        self.assertEqual(self.reg.count_host("192.0.2.1"), 1)
+        conn.ready = False
+        conn.capabilities.mccp2 = False
+        self.reg.reindex(conn)
+        self.assertConsistent()
+        self.assertEqual(self.reg.ready_connections(), ())
+        self.assertNotIn("mccp2", self.reg.flags)
+
+    def test_reindex_unknown_is_ignored(self):
+        self.reg.reindex(make_conn("ghost"))
+        self.assertNotIn("ghost", self.reg)
+        self.assertEqual(self.reg.keys, dict())
+
+    def test_pop_clears_every_index(self):
+        conn = make_conn("a", client_name="MUDLET", ready=True, mccp2=True)
+        self.reg.add(conn)
+        self.reg.add(make_conn("b"))
+        self.assertIs(self.reg.pop("a"), conn)
+        self.assertIsNone(self.reg.pop("a"))
+        self.assertEqual(self.reg.pop("a", "gone"), "gone")
+        self.assertConsistent()
+        self.assertNotIn("MUDLET", self.reg.clients)
+        self.assertNotIn("mccp2", self.reg.flags)
+        self.assertEqual(self.reg.ready, dict())
+        other = self.reg.get("b")
+        self.assertIs(self.reg.remove(other), other)
+        self.assertIsNone(self.reg.remove(other))
+        self.assertEqual(len(self.reg), 0)
+        self.assertConsistent()
+        self.assertEqual(self.reg.hosts, dict())
+        self.assertEqual(self.reg.listeners, dict())
+
+    def test_find(self):
+        self.reg.add(make_conn("a", listener="telnet", host="192.0.2.1", ready=True, mccp2=True))
+        self.reg.add(make_conn("b", listener="telnet", host="192.0.2.1", ready=False, mccp2=True))
+        self.reg.add(make_conn("c", listener="tls", host="192.0.2.1", ready=True))
+        self.reg.add(make_conn("d", listener="telnet", host="192.0.2.9", client_name="MUDLET", ready=False))
+        self.assertEqual(names(self.reg.find()), ["a", "b", "c", "d"])
+        self.assertEqual(names(self.reg.find(ready=True)), ["a", "c"])
+        self.assertEqual(names(self.reg.find(ready=False)), ["b", "d"])
+        self.assertEqual(names(self.reg.find(listener="telnet", host="192.0.2.1")), ["a", "b"])
+        self.assertEqual(names(self.reg.find(listener="telnet", flags=("mccp2",), ready=False)), ["b"])
+        self.assertEqual(names(self.reg.find(host="192.0.2.1", ready=True)), ["a", "c"])
+        self.assertEqual(names(self.reg.find(client_name="MUDLET", ready=False)), ["d"])
+        self.assertEqual(names(self.reg.find(client_name="MUDLET", ready=True)), [])
+        self.assertEqual(names(self.reg.find(flags=("mccp2", "gmcp"))), [])
+        self.assertEqual(names(self.reg.find(listener="nowhere")), [])
+
+    def test_snapshot_cache(self):
+        conn = make_conn("a")
+        self.reg.add(conn)
+        first = self.reg.snapshot()
+        self.assertIs(self.reg.snapshot(), first)
+        # Reindexing changes no membership, so the snapshot survives it.
+        conn.ready = True
+        self.reg.reindex(conn)
+        self.assertIs(self.reg.snapshot(), first)
+        self.reg.add(make_conn("b"))
+        second = self.reg.snapshot()
+        self.assertIsNot(second, first)
+        self.assertEqual(names(second), ["a", "b"])
+        # Iterating while removing sees the snapshot taken before.
+        for c in self.reg:
+            self.reg.remove(c)
+        self.assertEqual(len(self.reg), 0)
+        self.assertEqual(self.reg.snapshot(), ())
+        self.assertEqual(names(second), ["a", "b"])
+
+    def test_counts(self):
+        self.reg.add(make_conn("a", client_name="MUDLET", ready=True))
+        self.reg.add(make_conn("b", listener="tls"))
+        self.assertEqual(self.reg.counts(), {
+            "total": 2,
+            "ready": 1,
+            "listeners": {"telnet": 1, "tls": 1},
+            "clients": {"MUDLET": 1, "UNKNOWN": 1},
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import unittest
+import zlib
+
+from mudlink.splice import adler32_combine, StaticBlob
+
+
+class TestAdler32Combine(unittest.TestCase):
+
+    def check(self, a, b):
+        combined = adler32_combine(zlib.adler32(a), zlib.adler32(b), len(b))
+        self.assertEqual(combined, zlib.adler32(a + b))
+
+    def test_simple(self):
+        self.check(b"hello ", b"world")
+
+    def test_empty(self):
+        self.check(b"", b"")
+        self.check(b"abc", b"")
+        self.check(b"", b"abc")
+
+    def test_modulus_edges(self):
+        # Lengths around the adler32 modulus, and high bytes that push both sums towards it.
+        for size in (1, 65520, 65521, 65522, 200000):
+            self.check(b"\xff" * 1000, b"\xff" * size)
+
+    def test_random(self):
+        for _ in range(50):
+            a = os.urandom(int.from_bytes(os.urandom(2), "big"))
+            b = os.urandom(int.from_bytes(os.urandom(2), "big"))
+            self.check(a, b)
+
+
+class TestStaticBlob(unittest.TestCase):
+
+    def test_splice_into_stream(self):
+        blob = StaticBlob("motd", b"Welcome \xff!\r\n" * 50)
+        self.assertEqual(blob.plain.count(b"\xff\xff"), 50)
+
+        compressor = zlib.compressobj(9)
+        before, after = b"before\r\n", b"after\r\n"
+        stream = compressor.compress(before) + compressor.flush(zlib.Z_FULL_FLUSH) + blob.compressed
+        stream += compressor.compress(after) + compressor.flush(zlib.Z_FINISH)
+        # Patch the trailer the way TelnetMudConnection does once something was spliced.
+        adler = adler32_combine(zlib.adler32(before), blob.adler, blob.length)
+        adler = zlib.adler32(after, adler)
+        stream = stream[:-4] + adler.to_bytes(4, "big")
+
+        decompressor = zlib.decompressobj()
+        self.assertEqual(decompressor.decompress(stream), before + blob.plain + after)
+        self.assertTrue(decompressor.eof)
+
+
+if __name__ == "__main__":
+    unittest.main()